@@ -1,6 +1,12 @@
 import re
+import time
+import threading
+import binascii
+import collections
 import ldap
-from amlib import conf, utils, log, cnx
+from ldap.controls import LDAPControl, SimplePagedResultsControl
+from amlib import conf, utils, log, cnx, adstate
+from amlib.entry import MapEntry, MasterEntry
 
 '''
 Functions for parsing AD automount maps into a common dict format.
@@ -46,26 +52,432 @@ this format (extraneous fields removed):
 '''
 
 
-def get_names():
+'''
+Snapshot of the whole automount container, read with one subtree search
+and indexed by map and key:
+
+{'auto.foobar': {'dn':      'CN=auto.foobar,CN=automounts,...',
+                 'attrs':   {'cn': ['auto.foobar'], ...},
+                 'entries': {'baz': ('CN=baz,CN=auto.foobar,...',
+                                     {'cn': ['baz'], ...}), ...}}, ...}
+
+Map names and keys are lowercased for lookups; AD doesn't care about case
+either. Every reader below works from the snapshot. ad_op keeps it current
+after our own writes via note_add(), note_modify() and note_delete().
+'''
+SNAPSHOT_ATTRS = ['cn', 'nisMapName', 'nisMapEntry', 'uSNChanged',
+                  'objectGUID']
+_snap = None
+_lock = threading.RLock()  # --jobs workers update the snapshot concurrently
+
+
+def load(live=False):
     '''
-Return a list of automount maps in AD/${conf/am_container} with auto.master
-and auto.direct first.
+Read ${conf/am_container} into the snapshot. Return False if the
+container does not exist.
+
+If the state file from an earlier run was written against the same DC,
+only objects whose uSNChanged is above its watermark are read and merged
+into the cached rows, and if the DC's highestCommittedUSN hasn't moved
+since, nothing in the container is read at all. Otherwise the whole
+container is read.
+
+With live, the whole container is read and the state file is neither
+used nor written: the read tools (dump_admaps, verify_admaps) use this
+to look at AD without touching what ampush keeps between runs.
     '''
-    l_names, ad_map_names = [], []
+    global _snap
+
+    # take the watermark before reading: anything that changes while we
+    # read will be picked up again next time
+    dse = root_dse()
+    state = None
+    if live is False:
+        state = _read_state(dse=dse)
 
+    _snap = {}
     try:
-        results = cnx.c.search(filter='(cn=*)', base=conf.c['am_container'],
-                               scope=ldap.SCOPE_ONELEVEL)  # exclude parent cn
+        if state is None:
+            log.m.debug('Reading ' + conf.c['am_container'])
+            rows = {}
+            for dn, attrs in search(base=conf.c['am_container'],
+                                    attrs=SNAPSHOT_ATTRS):
+                rows[_guid(attrs)] = (dn, attrs)
+        elif state['usn'] == dse['usn']:
+            log.m.debug('Nothing has changed on {0} since USN {1}'.format(
+                dse['dc'], dse['usn']))
+            rows = state['rows']
+        else:
+            rows = state['rows']
+            _merge_changes(rows=rows, usn=state['usn'], nc=dse['nc'])
     except ldap.NO_SUCH_OBJECT:
+        _snap = None
+        return False
+
+    placed = []
+    for guid, (dn, attrs) in rows.items():
+        map_key, entry_key = _index(dn=dn, attrs=attrs)
+        placed.append((guid, map_key, entry_key, dn, attrs))
+    if live is False and (state is None or state['usn'] != dse['usn']):
+        _write_state(dse=dse, rows=placed)
+    return True
+
+
+def _guid(attrs=None):
+    ''' Pop the binary objectGUID off attrs and return it as hex. '''
+    return _hex(attrs.pop('objectGUID')[0])
+
+
+def _hex(in_bytes):
+    return str(binascii.hexlify(in_bytes).decode('ascii'))
+
+
+def _merge_changes(rows=None, usn=None, nc=None):
+    '''
+Update cached rows with everything changed or deleted in the container
+since USN usn. Deleted objects only show up as tombstones in
+CN=Deleted Objects, and only with the LDAP_SERVER_SHOW_DELETED control.
+Return the set of (lowercased) map names that were touched.
+    '''
+    log_msg = 'Reading changes to {0} since USN {1}'
+    log.m.debug(log_msg.format(conf.c['am_container'], usn))
+    changed = '(uSNChanged>={0})'.format(int(usn) + 1)
+    maps = set()
+
+    for dn, attrs in search(base=conf.c['am_container'],
+                            filterstr=changed,
+                            attrs=SNAPSHOT_ATTRS):
+        guid = _guid(attrs)
+        if guid in rows:  # renamed or moved within the container
+            maps.add(split_dn(rows[guid][0])[0])
+        rows[guid] = (dn, attrs)
+        maps.add(split_dn(dn)[0])
+
+    show_deleted = LDAPControl(SHOW_DELETED_OID, True, None)
+    for dn, attrs in search(base='CN=Deleted Objects,' + nc,
+                            scope=ldap.SCOPE_ONELEVEL,
+                            filterstr='(&(isDeleted=TRUE){0})'.format(changed),
+                            attrs=['objectGUID'],
+                            controls=[show_deleted]):
+        row = rows.pop(_guid(attrs), None)
+        if row is not None:
+            maps.add(split_dn(row[0])[0])
+
+    maps.discard(None)
+    log.m.debug('{0} maps changed in AD since last run'.format(len(maps)))
+    return maps
+
+
+'''
+The state file (amlib/adstate.py) holds the rows from the last read, the
+DC's highestCommittedUSN from just before that read, and the identity of
+the DC. USNs are local to one DC, and a DC restored from backup gets a new
+invocationId, so the watermark is only trusted if both still match.
+'''
+SHOW_DELETED_OID = '1.2.840.113556.1.4.417'
+
+
+def root_dse():
+    ''' Return the current DC's identity and highestCommittedUSN. '''
+    l = cnx.ldap_conn()
+    dn, attrs = l.search_s('', ldap.SCOPE_BASE, '(objectClass=*)',
+                           ['highestCommittedUSN', 'dsServiceName',
+                            'dnsHostName', 'defaultNamingContext'])[0]
+    dn, ntds = l.search_s(attrs['dsServiceName'][0], ldap.SCOPE_BASE,
+                          '(objectClass=*)', ['invocationId'])[0]
+
+    return {'usn': attrs['highestCommittedUSN'][0],
+            'dc': attrs['dnsHostName'][0],
+            'invocation_id': _hex(ntds['invocationId'][0]),
+            'nc': attrs['defaultNamingContext'][0]}
+
+
+def _trusted(state=None, dse=None):
+    ''' Can the watermark in state (adstate.meta()) be used with dse? '''
+    if state is None or state['container'] != conf.c['am_container']:
+        return False
+
+    if state['dc'] != dse['dc'] or \
+       state['invocation_id'] != dse['invocation_id']:
+        log_msg = 'Last run read AD from {0}, this one is using {1}. ' + \
+                  'Reading the whole container.'
+        log.m.info(log_msg.format(state['dc'], dse['dc']))
+        return False
+
+    # tombstones don't live forever; reread everything now and then
+    if time.time() - state['time'] > float(conf.c['snapshot_max_age']):
+        log.m.debug('State file is too old. Reading the whole container.')
+        return False
+    return True
+
+
+def _read_state(dse=None):
+    ''' Return the last run's state if it can be trusted, else None. '''
+    if _trusted(state=adstate.meta(), dse=dse) is False:
+        return None
+    return adstate.read()
+
+
+def _write_state(dse=None, rows=None):
+    state = {'container': conf.c['am_container'],
+             'dc': dse['dc'],
+             'invocation_id': dse['invocation_id'],
+             'usn': dse['usn'],
+             'time': time.time()}
+    adstate.write(state=state, rows=rows)
+    return
+
+
+def refresh_state():
+    '''
+Bring the state file up to date for the read tools' --cached. If the DC's
+highestCommittedUSN is where the state file left it, that costs one root
+DSE read; if not, the changes are read as a sync would read them.
+    '''
+    global _snap
+    dse = root_dse()
+    state = adstate.meta()
+    if _trusted(state=state, dse=dse) and state['usn'] == dse['usn']:
+        log.m.debug('State file is current as of USN ' + dse['usn'])
+        return
+    _snap = None  # load() again, even if this process has a snapshot
+    snapshot()
+    return
+
+
+def search(base=None, scope=ldap.SCOPE_SUBTREE, filterstr='(cn=*)',
+           attrs=None, controls=None):
+    '''
+Generator. Yield (dn, attrs) rows from a paged search (RFC 2696) as each
+page arrives. A plain search is silently cut off at AD's MaxPageSize.
+The next page is requested before the current one is handed out, so the
+caller's work overlaps with the DC's.
+
+Paging cookies don't survive a reconnect. If the connection is lost, the
+search starts over on the new one, and rows already yielded are skipped.
+    '''
+    l = cnx.ldap_conn()
+    seen = set()
+    retries = int(conf.c['ldap_retries'])
+    for attempt in range(retries + 1):
+        ctrl = SimplePagedResultsControl(True,
+                                         size=int(conf.c['ldap_page_size']),
+                                         cookie='')
+        ctrls = [ctrl] + (controls or [])
+        try:
+            msgid = l.search_ext(base, scope, filterstr, attrs,
+                                 serverctrls=ctrls)
+            while msgid is not None:
+                rtype, rdata, rmsgid, rctrls = l.result3(msgid)
+
+                msgid = None
+                for rctrl in rctrls:
+                    if rctrl.controlType == \
+                       SimplePagedResultsControl.controlType \
+                       and rctrl.cookie:
+                        ctrl.cookie = rctrl.cookie
+                        msgid = l.search_ext(base, scope, filterstr, attrs,
+                                             serverctrls=ctrls)
+
+                for dn, entry in rdata:
+                    # skip search continuation references
+                    if dn is not None and dn.lower() not in seen:
+                        seen.add(dn.lower())
+                        yield dn, entry
+            return
+        except cnx.RETRY_ON as e:
+            if attempt == retries:
+                raise
+            log_msg = 'Search of {0} interrupted ({1}); starting over'
+            log.m.warning(log_msg.format(base, e.__class__.__name__))
+    return
+
+
+def snapshot(live=False):
+    ''' Return the snapshot, reading it from AD (see load()) on first use. '''
+    if _snap is None and load(live=live) is False:
         log_msg = "Can't find automount container in AD: {0}. Terminating."
         log_msg = log_msg.format(conf.c['am_container'])
         log.m.critical(log_msg)
         print(log_msg)
         exit(7)
+    return _snap
+
+
+def split_dn(dn):
+    '''
+Return (map name, key) for a DN inside the container. Either may be None:
+(None, None) is the container itself, (map, None) is a nisMap.
+    '''
+    rdns = ldap.dn.str2dn(dn)
+    depth = len(rdns) - len(ldap.dn.str2dn(conf.c['am_container']))
+    if depth == 1:
+        return rdns[0][0][1].lower(), None
+    if depth == 2:
+        return rdns[1][0][1].lower(), rdns[0][0][1].lower()
+    return None, None
+
+
+def _index(dn=None, attrs=None):
+    ''' Add a row to the snapshot. Return split_dn(dn). '''
+    map_key, entry_key = split_dn(dn)
+    if map_key is None:
+        return map_key, entry_key
+    if map_key not in _snap:
+        _snap[map_key] = {'dn': None, 'attrs': {}, 'entries': {}}
+    if entry_key is None:
+        _snap[map_key]['dn'] = dn
+        _snap[map_key]['attrs'] = attrs
+    else:
+        _snap[map_key]['entries'][entry_key] = (dn, attrs)
+    return map_key, entry_key
+
+
+def note_add(dn=None, attrs=None):
+    ''' Record an object we just created in AD. '''
+    if _snap is None:
+        return
+    kept = {}
+    for k, v in attrs.items():
+        if k in SNAPSHOT_ATTRS:
+            kept[k] = v
+    with _lock:
+        _index(dn=dn, attrs=kept)
+    return
+
+
+def note_modify(dn=None, attrs=None):
+    ''' Record replaced attribute values on an object we just modified. '''
+    if _snap is None:
+        return
+    map_key, entry_key = split_dn(dn)
+    with _lock:
+        try:
+            if entry_key is None:
+                row = _snap[map_key]['attrs']
+            else:
+                row = _snap[map_key]['entries'][entry_key][1]
+        except KeyError:
+            return
+        row.update(attrs)
+        row.pop('uSNChanged', None)  # AD has given it a new one
+    return
+
+
+def note_delete(dn=None):
+    ''' Forget an object we just deleted from AD. '''
+    if _snap is None:
+        return
+    map_key, entry_key = split_dn(dn)
+    with _lock:
+        if entry_key is None:
+            _snap.pop(map_key, None)
+        elif map_key in _snap:
+            _snap[map_key]['entries'].pop(entry_key, None)
+    return
+
+
+def exists(map_name=None):
+    ''' Does the nisMap object for map_name exist in AD? '''
+    m = snapshot().get(map_name.lower())
+    return m is not None and m['dn'] is not None
+
+
+def fingerprint(map_name=None):
+    '''
+Return a token that changes whenever map_name changes in AD: how many
+objects it has, and the highest uSNChanged among them. None if the map
+doesn't exist, or if this run has written to it and so doesn't know all
+of its USNs.
+
+USNs are local to one DC, so a token taken from another DC won't match.
+That only costs a comparison.
+    '''
+    with _lock:
+        m = snapshot().get(map_name.lower())
+        if m is None or m['dn'] is None:
+            return None
+        usns = [m['attrs'].get('uSNChanged')]
+        usns.extend([attrs.get('uSNChanged')
+                     for dn, attrs in m['entries'].values()])
+    if None in usns:
+        return None
+    return '{0}:{1}'.format(len(usns), max([int(u[0]) for u in usns]))
+
+
+def rows(map_name=None):
+    '''
+Return the (dn, attrs) rows for every entry in map_name, or None if the
+map does not exist.
+    '''
+    with _lock:
+        if exists(map_name) is False:
+            return None
+        return list(snapshot()[map_name.lower()]['entries'].values())
+
+
+def lookup(dn=None):
+    ''' Return the snapshot's attrs for dn, or None if it isn't in AD. '''
+    map_key, entry_key = split_dn(dn)
+    with _lock:
+        m = snapshot().get(map_key)
+        if m is None:
+            return None
+        if entry_key is None:
+            return m['attrs']
+        entry = m['entries'].get(entry_key)
+        if entry is None:
+            return None
+        return entry[1]
+
+
+def read(dns=None, attrs=None):
+    '''
+Generator. Yield (dn, attrs) straight from AD for each of dns, with attrs
+None if the object doesn't exist. Up to ${ampush.conf/ldap_window}
+base-scope reads are kept outstanding at once.
+    '''
+    l = cnx.ldap_conn()
+    window = int(conf.c['ldap_window'])
+    pending = collections.deque()
+    for dn in dns:
+        msgid = l.search_ext(dn, ldap.SCOPE_BASE, '(objectClass=*)', attrs)
+        pending.append((dn, msgid))
+        if len(pending) >= window:
+            yield _read_one(l, *pending.popleft())
+    while pending:
+        yield _read_one(l, *pending.popleft())
+    return
+
+
+def _read_one(l, dn, msgid):
+    try:
+        rtype, rdata, rmsgid, rctrls = l.result3(msgid)
+    except ldap.NO_SUCH_OBJECT:
+        return dn, None
+    for row_dn, row_attrs in rdata:
+        if row_dn is not None:
+            return dn, row_attrs
+    return dn, None
 
-    for obj in results:
-        ad_map_names.append(obj[1]['cn'][0])
 
+def get_names():
+    '''
+Return a list of automount maps in AD/${conf/am_container} with auto.master
+and auto.direct first.
+    '''
+    ad_map_names = []
+
+    with _lock:
+        for m in snapshot().values():
+            if m['dn'] is not None:
+                ad_map_names.append(m['attrs']['cn'][0])
+    return order_names(ad_map_names)
+
+
+def order_names(ad_map_names=None):
+    ''' Put auto.master, then auto.direct, then the other auto.* maps. '''
+    l_names, ad_map_names = [], list(ad_map_names)
     l_names.append(conf.c['master_map_name'])
 
     try:
@@ -100,73 +512,70 @@ Ingest a list of automount map entries. Return a nice dict like this:
  'luma': {'options':         '-nosuid,tcp,intr,bg,vers=3,rw',
           'server_dir':      '/exports/luma',
           'server_hostname': 'nfssrv02.example.com'}, ...}
+
+Values are entry.MapEntry records; see amlib/entry.py.
     '''
     d_map = {}
 
-    am_cn = 'cn={0},{1}'.format(map_name, conf.c['am_container'])
-    log.m.debug('Reading ' + am_cn)
-
-    try:
-        results = (cnx.c.search(filter='(cn=*)',
-                                base=am_cn,
-                                scope=ldap.SCOPE_SUBTREE))
-    except ldap.NO_SUCH_OBJECT:
+    results = rows(map_name)
+    if results is None:
         return None
 
-    for row in results[1:]:  # skip the container itself
-        if utils.has_slash_prefix(row[1]['cn'][0]) is True:
-            log_msg = (
-                'AD:{0}=>{1} has a leading slash in its CN. This is bad. '
-                'Something has gone horribly wrong and you should file '
-                'a bug. Please include your flat file automount maps '
-                'with anonymized hostnames.'
-            ).format(map_name, row[1]['cn'][0])
-            log.m.critical(log_msg)
-            print(log_msg)
-            exit(5)
-
-        '''
+    for row in results:
+        am_key, entry = submap_entry(map_name=map_name, attrs=row[1])
+        d_map[am_key] = entry
+    return d_map
+
+
+def submap_entry(map_name=None, attrs=None):
+    ''' Return (key, MapEntry) for one nisObject of a submap. '''
+    if utils.has_slash_prefix(attrs['cn'][0]) is True:
+        log_msg = (
+            'AD:{0}=>{1} has a leading slash in its CN. This is bad. '
+            'Something has gone horribly wrong and you should file '
+            'a bug. Please include your flat file automount maps '
+            'with anonymized hostnames.'
+        ).format(map_name, attrs['cn'][0])
+        log.m.critical(log_msg)
+        print(log_msg)
+        exit(5)
+
+    '''
 When providing a view of the AD map, use cn rather than nisMapName
 to avoid returning a leading slash when parsing common maps.
 
 For the direct map, which will have a leading slash in the flat
 file equivalent, return nisMapName for easy comparison.
-        '''
-        if map_name == conf.c['direct_map_name']:
-            am_key = row[1]['nisMapName'][0]
-        else:
-            am_key = row[1]['cn'][0]
+    '''
+    if map_name == conf.c['direct_map_name']:
+        am_key = attrs['nisMapName'][0]
+    else:
+        am_key = attrs['cn'][0]
 
-        chunks = row[1]['nisMapEntry'][0].split()
-        utils.validate_nis_map_entry(in_list=chunks,
-                                     map_name=map_name,
-                                     am_key=am_key,
-                                     map_type='Active Directory')
-        d_map[am_key] = {}
+    chunks = attrs['nisMapEntry'][0].split()
+    utils.validate_nis_map_entry(in_list=chunks,
+                                 map_name=map_name,
+                                 am_key=am_key,
+                                 map_type='Active Directory')
 
-        '''
+    '''
 Consider these two valid automount entries:
     apps -tcp,vers=3 nfs-server1.example.com:/exports/apps
     data nfs-server2.example.com:/srv/data
 
 If a third field exists, use it as the NFS path.
 Otherwise use the second field as the NFS path.
-        '''
-        try:  # server:path pair with options
-            server_hostname, server_dir = chunks[1].split(':')
-            options = chunks[0]
-            utils.validate_mount_options(opt_str=options,
-                                         map_name=map_name,
-                                         am_key=am_key)
-            d_map[am_key] = {'options': options,
-                             'server_hostname': server_hostname,
-                             'server_dir': server_dir}
-        except IndexError:  # without options
-            server_hostname, server_dir = chunks[0].split(':')
-            d_map[am_key] = {'options': None,
-                             'server_hostname': server_hostname,
-                             'server_dir': server_dir}
-    return d_map
+    '''
+    try:  # server:path pair with options
+        server_hostname, server_dir = chunks[1].split(':')
+        options = chunks[0]
+        utils.validate_mount_options(opt_str=options,
+                                     map_name=map_name,
+                                     am_key=am_key)
+        return am_key, MapEntry(server_hostname, server_dir, options)
+    except IndexError:  # without options
+        server_hostname, server_dir = chunks[0].split(':')
+        return am_key, MapEntry(server_hostname, server_dir, None)
 
 
 def parse_master():
@@ -179,6 +588,8 @@ Ingest master map from AD. Return a nice dict like this:
  '/baz': {'map': 'auto.baz',
       'options': '-ro,int,soft,bg,fstype=nfs4,port=2049'},}
 
+Values are entry.MasterEntry records; see amlib/entry.py.
+
 Note the leading slashes on the keys. We add them there for
 easy comparison with the flat file master map. All map entries
 outside of the master map should be returned without leading
@@ -187,46 +598,95 @@ slashes.
     map_name = conf.c['master_map_name']
     d_map = {}
 
-    am_cn = 'cn={0},{1}'.format(map_name, conf.c['am_container'])
-    log.m.debug('Reading ' + am_cn)
-
-    try:
-        results = (cnx.c.search(filter='(cn=*)',
-                                base=am_cn,
-                                scope=ldap.SCOPE_SUBTREE))
-    except ldap.NO_SUCH_OBJECT:
+    results = rows(map_name)
+    if results is None:
         return None
 
-    for row in results[1:]:  # skip the container itself
-        am_key = row[1]['nisMapName'][0]
-        chunks = row[1]['nisMapEntry'][0].split()
-        d_map[am_key] = {}
-        joined = '{0}:{1}'.format(am_key, row[1]['nisMapEntry'][0])
-        '''
+    for row in results:
+        am_key, entry = master_entry(attrs=row[1])
+        d_map[am_key] = entry
+    return d_map
+
+
+def master_entry(attrs=None):
+    ''' Return (key, MasterEntry) for one nisObject of the master map. '''
+    am_key = attrs['nisMapName'][0]
+    chunks = attrs['nisMapEntry'][0].split()
+    joined = '{0}:{1}'.format(am_key, attrs['nisMapEntry'][0])
+    '''
 As with submaps the mount options field is optional.
 1 field == automount entry without mount options.
-        '''
-        if len(chunks) == 1:
-            d_map[am_key] = {'map': chunks[0]}
-            log_msg = 'No mount options for {0} in {1}'
-            log_msg = log_msg.format(am_key, conf.c['master_map_name'])
-            log.m.info(log_msg)
-
-        # 3 fields? automount directory + mapname + mount options
-        elif len(chunks) == 2:
-            d_map[am_key] = {'map': chunks[0],
-                             'options': chunks[1]}
+    '''
+    if len(chunks) == 1:
+        log_msg = 'No mount options for {0} in {1}'
+        log_msg = log_msg.format(am_key, conf.c['master_map_name'])
+        log.m.info(log_msg)
+        return am_key, MasterEntry(map=chunks[0])
+
+    # 3 fields? automount directory + mapname + mount options
+    elif len(chunks) == 2:
+        return am_key, MasterEntry(map=chunks[0], options=chunks[1])
+
+    log_msg = (
+        'Terminating. Bad Active Directory master map format: '
+        'unexpected number of fields in ' + joined
+    )
+    log.m.critical(log_msg)
+    print(log_msg)
+    exit(10)
+
 
+STREAM_ATTRS = ['objectClass', 'cn', 'nisMapName', 'nisMapEntry']
+
+
+def stream(map_name=None, cached=False):
+    '''
+Generator. Yield (dn, attrs, key, entry) for every entry of map_name, read
+straight from AD a page at a time instead of from the snapshot, or with
+cached from the state file (see refresh_state()). The whole-map sanity
+checks that parse() makes are skipped: this is for listing maps (amcat),
+not for syncing them.
+    '''
+    if cached:
+        rows = _cached_rows(adstate.map_rows(map_name), conf.c['t_nisobj'])
+    else:
+        rows = search(base=utils.map_cn(map_name),
+                      scope=ldap.SCOPE_ONELEVEL,
+                      attrs=STREAM_ATTRS)
+    for dn, attrs in rows:
+        if map_name == conf.c['master_map_name']:
+            am_key, entry = master_entry(attrs=attrs)
         else:
-            log_msg = (
-                'Terminating. Bad Active Directory master map format: '
-                'unexpected number of fields in ' + joined
-            )
-            log.m.critical(log_msg)
-            print(log_msg)
-            exit(10)
+            am_key, entry = submap_entry(map_name=map_name, attrs=attrs)
+        yield dn, attrs, am_key, entry
+    return
+
+
+def stream_head(map_name=None, cached=False):
+    ''' Return (dn, attrs) for map_name's nisMap object, or None. '''
+    if cached:
+        row = adstate.map_object(map_name)
+        if row is None:
+            return None
+        return list(_cached_rows([row], conf.c['t_nismap']))[0]
+    try:
+        return list(search(base=utils.map_cn(map_name),
+                           scope=ldap.SCOPE_BASE,
+                           attrs=STREAM_ATTRS))[0]
+    except ldap.NO_SUCH_OBJECT:
+        return None
 
-    return d_map
+
+def _cached_rows(rows=None, object_class=None):
+    '''
+The state file keeps SNAPSHOT_ATTRS, not STREAM_ATTRS; return what the
+search in stream() would have.
+    '''
+    for dn, attrs in rows:
+        attrs.pop('uSNChanged', None)
+        attrs['objectClass'] = ['top', object_class]
+        yield dn, attrs
+    return
 
 
 def parse(map_name=None):
@@ -1,9 +1,12 @@
 import ldap
-import conf, cnx, log, utils
+import time
+import threading
+import conf, cnx, log, utils, metrics
 import ldap.modlist as modlist
+from amlib import ad_map, pipeline
 
 '''
-Functions for manipulating AD objects with python-ad.
+Functions for manipulating AD objects with python-ldap.
 Part of ampush. https://github.com/sfu-rcg/ampush
 Copyright (C) 2016-2017 Research Computing Group, Simon Fraser University.
 '''
@@ -12,14 +15,14 @@ Copyright (C) 2016-2017 Research Computing Group, Simon Fraser University.
 def get(cn=None, scope=ldap.SCOPE_SUBTREE):
     ''' Return one or more objects from Active Directory. '''
     try:
-        return cnx.c.search(base=cn)
+        return _pipe().search(base=cn, scope=scope)
     except ldap.NO_SUCH_OBJECT:
         return None
     return
 
 
 def verify_am_container_exists():
-    if get(conf.c['am_container']) is None:
+    if ad_map.load() is False:
         log_msg = 'Terminating. Automount container {0} does not exist in AD'
         log_msg = log_msg.format(conf.c['am_container'])
         log.m.critical(log_msg)
@@ -28,19 +31,241 @@ def verify_am_container_exists():
     return
 
 
+'''
+Writes go through an asynchronous pipeline.Pipeline, one per thread, that
+keeps up to ${ampush.conf/ldap_window} operations in flight on the
+thread's connection.
+
+Batched writes. Outside a batch, every write is waited for and followed by
+wait_for_replication(). Between batch_begin() and batch_end(), add_obj(),
+mod_obj() and _del() only submit their writes. batch_flush() collects the
+results and waits for replication once; it runs at batch_end() and every
+${ampush.conf/replication_batch_size} writes.
+
+With ${ampush.conf/replication_confirm} on, batch_flush() doesn't sleep
+for a fixed time. It reads the batch's objects back (confirm()) and waits
+only as long as some write isn't visible yet.
+'''
+_local = threading.local()  # .pipe, .batching, .unflushed (write count),
+#                             .written (writes to confirm)
+_pipes = []                 # every thread's pipeline, for failure_count()
+_released = {'failures': 0, 'submitted': 0}  # of pipelines since released
+_lock = threading.Lock()
+
+
+def _pipe():
+    ''' Return this thread's pipeline. '''
+    if getattr(_local, 'pipe', None) is None:
+        _local.pipe = pipeline.Pipeline(conn=cnx.ldap_conn(),
+                                        window=int(conf.c['ldap_window']),
+                                        on_done=_note,
+                                        retries=int(conf.c['ldap_retries']))
+        _local.unflushed = 0
+        _local.written = []
+        with _lock:
+            _pipes.append(_local.pipe)
+    return _local.pipe
+
+
+def _note(op=None, dn=None, args=None):
+    ''' Keep the ad_map snapshot in step with writes that succeeded. '''
+    _local.written.append((op, dn, args))
+    if op == 'add':
+        ad_map.note_add(dn=dn, attrs=dict(args))
+    elif op == 'modify':
+        ad_map.note_modify(dn=dn, attrs=dict((a, v) for o, a, v in args))
+    else:
+        ad_map.note_delete(dn=dn)
+    return
+
+
+def release():
+    '''
+Finish this thread's writes, drop its pipeline and give its connection
+back to cnx's pool. Its failures still count towards failure_count().
+    '''
+    pipe = getattr(_local, 'pipe', None)
+    if pipe is not None:
+        try:
+            batch_flush()
+        finally:
+            _local.pipe = None
+            with _lock:
+                _pipes.remove(pipe)
+                _released['failures'] += len(pipe.failures)
+                _released['submitted'] += pipe.submitted
+    cnx.release()
+    return
+
+
+def failure_count():
+    ''' Number of writes AD has refused so far, across all threads. '''
+    with _lock:
+        return _released['failures'] + sum([len(p.failures) for p in _pipes])
+
+
+def write_count():
+    ''' Number of writes sent to AD so far, across all threads. '''
+    with _lock:
+        return _released['submitted'] + sum([p.submitted for p in _pipes])
+
+
+'''
+ampush --plan: record each write, and what AD held beforehand, instead
+of making it. expect is None for an add (the object mustn't exist), {}
+for a delete (it must) and, for a modify, the attribute values it
+replaces. The same write recorded twice, e.g. by a conflict resync, is
+kept once.
+'''
+_plan_ops = None
+_plan_seen = set()
+
+
+def record_begin():
+    global _plan_ops
+    _plan_ops = []
+    _plan_seen.clear()
+    return
+
+
+def recorded():
+    ''' Return the writes recorded since record_begin(), in order. '''
+    return _plan_ops
+
+
+def _record(op=None, dn=None, args=None):
+    seen_key = (op, dn.lower(), repr(args))
+    if seen_key in _plan_seen:
+        return
+    _plan_seen.add(seen_key)
+
+    if op == 'add':
+        expect = None
+    elif op == 'delete':
+        expect = {}
+    else:
+        current = ad_map.lookup(dn) or {}
+        expect = dict((attr, current.get(attr)) for mod_op, attr, v in args)
+    _plan_ops.append({'op': op, 'dn': dn, 'args': args, 'expect': expect})
+    return
+
+
+def replay(op=None, dn=None, args=None):
+    ''' Make one write read back from a plan file. '''
+    log.m.info('ad_{0} {1}'.format(op, dn))
+    _write(op=op, dn=dn, args=args)
+    return
+
+
+def batch_begin():
+    _local.batching = True
+    return
+
+
+def batch_flush():
+    ''' Collect all outstanding writes, then wait for replication once. '''
+    if getattr(_local, 'pipe', None) is None:  # nothing written yet
+        return
+    _local.pipe.drain()
+    if _local.unflushed > 0:
+        log.m.debug('batch_flush: {0} writes'.format(_local.unflushed))
+        _local.unflushed = 0
+        written, _local.written = _local.written, []
+        if conf.c['replication_confirm'] != '0':
+            confirm(written=written)
+        else:
+            utils.wait_for_replication()
+    return
+
+
+def confirm(written=None):
+    '''
+Read back the objects of written, a list of (op, dn, args) writes AD has
+accepted, until every one shows its write: an add exists, a delete is
+gone, a modify has its new values. Back off exponentially from
+${ampush.conf/replication_confirm_delay} seconds while any doesn't, for
+up to ${ampush.conf/replication_wait_time} seconds in all.
+    '''
+    todo = {}
+    for op, dn, args in written:  # the last write to a DN is what counts
+        todo[dn.lower()] = (op, dn, args)
+    attrs = set()
+    for op, dn, args in todo.values():
+        if op == 'modify':
+            attrs.update([attr for mod_op, attr, v in args])
+    attrs = sorted(attrs) or ['1.1']  # 1.1: no attributes, thanks
+
+    delay = float(conf.c['replication_confirm_delay'])
+    deadline = time.time() + float(conf.c['replication_wait_time'] or 10)
+    while True:
+        dns = [dn for op, dn, args in todo.values()]
+        for dn, current in ad_map.read(dns=dns, attrs=attrs):
+            if _visible(write=todo[dn.lower()], current=current) is True:
+                del todo[dn.lower()]
+        if len(todo) == 0:
+            return
+        if time.time() + delay > deadline:
+            log_msg = '{0} writes still not visible on the DC; carrying on'
+            log.m.warning(log_msg.format(len(todo)))
+            return
+        log.m.debug('confirm: {0} writes not visible yet; waiting {1}s'
+                    .format(len(todo), delay))
+        time.sleep(delay)
+        metrics.count('sleep_seconds', delay)
+        delay = delay * 2
+    return
+
+
+def _visible(write=None, current=None):
+    op, dn, args = write
+    if op == 'add':
+        return current is not None
+    if op == 'delete':
+        return current is None
+    if current is None:
+        return False
+    for mod_op, attr, v in args:
+        if current.get(attr) != v:
+            return False
+    return True
+
+
+def batch_end():
+    batch_flush()
+    _local.batching = False
+    return
+
+
+def _write(op=None, dn=None, args=None):
+    _pipe().submit(op=op, dn=dn, args=args)
+    _local.unflushed += 1
+    if getattr(_local, 'batching', False) is False or \
+       _local.unflushed >= int(conf.c['replication_batch_size']) > 0:
+        batch_flush()
+    return
+
+
 def add_obj(dn=None, debug_attrs=None, attrs=None, dry_run=True):
     log_msg = 'ad_create ' + str(debug_attrs)
     log_msg = utils.dry_msg(log_msg, dry_run=dry_run)
     log.m.debug(log_msg)
 
-    if dry_run is False:
-        try:
-            cnx.c.add(dn=dn, attrs=attrs)
-            utils.wait_for_replication()
-        except ldap.ALREADY_EXISTS:
-            log_msg = 'WARNING: Domain controller says {0} already exists'
-            log_msg = log_msg.format(dn)
-            log.m.warning(log_msg)
+    if _plan_ops is not None:
+        _record(op='add', dn=dn, args=attrs)
+    elif dry_run is False:
+        _write(op='add', dn=dn, args=attrs)
+    return
+
+
+def mod_obj(dn=None, debug_attrs=None, mods=None, dry_run=True):
+    log_msg = 'ad_modify {0} {1}'.format(dn, str(debug_attrs))
+    log_msg = utils.dry_msg(log_msg, dry_run=dry_run)
+    log.m.debug(log_msg)
+
+    if _plan_ops is not None:
+        _record(op='modify', dn=dn, args=mods)
+    elif dry_run is False:
+        _write(op='modify', dn=dn, args=mods)
     return
 
 
@@ -49,9 +274,10 @@ def _del(cn=None, dry_run=True):
     log_msg = utils.dry_msg(log_msg, dry_run=dry_run)
     log.m.info(log_msg)
 
-    if dry_run is False:
-        cnx.c.delete(dn=cn)
-        utils.wait_for_replication()
+    if _plan_ops is not None:
+        _record(op='delete', dn=cn)
+    elif dry_run is False:
+        _write(op='delete', dn=cn)
     return
 
 
@@ -60,12 +286,11 @@ def delete(cn=None, recurse=False, dry_run=True):
         _del(cn=cn, dry_run=dry_run)
     else:
         '''
-Delete contents of the auto.x container. Use SCOPE_ONELEVEL
-because we want to delete the contents of the container first,
-then the container itself.
+Delete contents of the auto.x container first, then the container itself.
+Its contents come from the ad_map snapshot.
         '''
-        objs = get(cn=cn, scope=ldap.SCOPE_ONELEVEL)
-        for obj in objs[1:]:  # skip parent container
+        objs = ad_map.rows(utils.cn_split(cn)[0]) or []
+        for obj in list(objs):
             # obj[0] is e.g., 'cn=supermnt,cn=auto.foo,cn=automounts,...'
 
             # these are just here to make pretty logs.
@@ -85,16 +310,16 @@ then the container itself.
     return
 
 
-def create_map_entry(map_name=None, entry_k=None, entry_v=None, dry_run=True):
-    ''' Create a nisObject in AD. One nisObject = one automount entry. '''
+def entry_dn(map_name=None, entry_k=None):
+    return 'cn={0},{1}'.format(utils.strip_slash(entry_k),
+                               utils.map_cn(map_name))
 
-    dn = 'cn={0},{1}'.format(utils.strip_slash(entry_k),
-                             utils.map_cn(map_name))
-    # log.m.debug('create nisObject: ' + dn)
 
-    # Format nisMapEntry. new_opts => new_entry => nisMapEntry
+def nis_map_entry(map_name=None, entry_v=None):
+    ''' Format an entry dict as a nisMapEntry value. '''
+    # new_opts => new_entry => nisMapEntry
     new_opts = ''
-    if entry_v['options'] is not None:  # options are optional. go figure.
+    if entry_v.get('options') is not None:  # options are optional. go figure.
         new_opts = entry_v['options']
     if map_name == conf.c['master_map_name']:  # auto.net -rw,intr,bg
         new_entry = '{0} {1}'.format(entry_v['map'], new_opts)
@@ -102,6 +327,15 @@ def create_map_entry(map_name=None, entry_k=None, entry_v=None, dry_run=True):
         new_entry = '{0} {1}:{2}'.format(new_opts,
                                          entry_v['server_hostname'],
                                          entry_v['server_dir'])
+    return new_entry.strip()
+
+
+def create_map_entry(map_name=None, entry_k=None, entry_v=None, dry_run=True):
+    ''' Create a nisObject in AD. One nisObject = one automount entry. '''
+
+    dn = entry_dn(map_name=map_name, entry_k=entry_k)
+    # log.m.debug('create nisObject: ' + dn)
+    new_entry = nis_map_entry(map_name=map_name, entry_v=entry_v)
 
     # Form LDIF.
     attrs = {}
@@ -109,7 +343,7 @@ def create_map_entry(map_name=None, entry_k=None, entry_v=None, dry_run=True):
     attrs['cn'] = [utils.strip_slash(entry_k)]
     attrs['name'] = [utils.strip_slash(entry_k)]
     attrs['nisMapName'] = [entry_k]
-    attrs['nisMapEntry'] = [new_entry.strip()]
+    attrs['nisMapEntry'] = [new_entry]
 
     '''
 Master and direct map entries: leading slash in nisMapName. Nowhere else.
@@ -132,39 +366,78 @@ server:path pair.
     return
 
 
-def conflict_catcher(map_name=None, delete_bad_objs=True):
-    ''' Scan a given automount container for duplicate/conflict objects,
+# cn=*\0ACNF:* -- \0A is a filter's way of writing the linefeed
+CNF_FILTER = '(cn=*\\0ACNF:*)'
+
+
+def conflict_sweep():
+    ''' Find duplicate/conflict objects anywhere in the automount container,
     identifiable by the presence of "{linefeed}CNF:" in the CN, e.g.:
 
 CN=software_installers\\0ACNF:5bb2ae10-d878-4fa6-8b4a-8c9d38888002,CN=auto.net,CN=automounts,OU=Linux,DC=ad,DC=example,DC=com
 
+    One subtree search, filtered by the DC, finds them all. They're deleted
+    in one batch, by the DNs it returns. A conflict nisMap goes along with
+    everything in it.
+
     No dry_run parameter since (1) we have flat file backups if things
     go horrendously wrong, and (2) nobody wants CNF objects sitting around.
 
-    Return True if conflict objects were found so that we can re-run
-    the sync elsewhere.
+    Return the set of (lowercased) map names that had conflict objects so
+    that we can re-run the sync on them.
     '''
-
-    from amlib import ad_map
-    import re
-
-    conflicts_found = False
-
-    log.m.debug('{0}: checking for conflict objects'.format(map_name))
-    if map_name == 'auto.master':
-        entries = ad_map.parse_master().keys()
-    else:
-        entries = ad_map.parse_submap(map_name=map_name).keys()
-
-    for entry in entries:
-        if b'\x0ACNF:' in entry:
-            conflicts_found = True
-            hexified_entry = re.sub('\\n', '\\\\0a', entry)
-            printable_entry = entry.encode('string_escape')  # escape newline
-            bad_cn = 'cn={0},cn={1},{2}'.format(hexified_entry,
-                                                map_name,
-                                                conf.c['am_container'])
-            log_msg = 'conflict: obj in {0}'.format(map_name)
-            log.m.info(log_msg)
-            _del(cn=bad_cn, dry_run=False)
-    return conflicts_found
+    log.m.debug('Checking {0} for conflict objects'.format(
+        conf.c['am_container']))
+    found = [dn for dn, attrs in ad_map.search(base=conf.c['am_container'],
+                                               filterstr=CNF_FILTER,
+                                               attrs=['1.1'])]
+    conflicted = set()
+    doomed = set()
+    for dn in found:
+        map_name, entry_key = ad_map.split_dn(dn)
+        if map_name is None:  # not where ampush puts things; leave it be
+            continue
+        if entry_key is None:  # a conflict nisMap
+            doomed.update([row[0] for row in get(cn=dn) or []])
+        map_name = map_name.split(b'\x0Acnf:')[0]
+        conflicted.add(map_name)
+        doomed.add(dn)
+        log.m.info('conflict: obj in {0}'.format(map_name))
+
+    if len(doomed) == 0:
+        return conflicted
+
+    # children first, and one replication wait for the lot
+    batch_begin()
+    for dn in sorted(doomed, key=lambda x: len(ldap.dn.str2dn(x)),
+                     reverse=True):
+        _del(cn=dn, dry_run=False)
+    batch_end()
+    return conflicted
+
+
+def modify_map_entry(map_name=None, entry_k=None, entry_v=None,
+                     ad_entry_v=None, dry_run=True):
+    '''
+Rewrite the nisMapEntry of an existing nisObject in place. One write instead
+of a delete followed by a create, and the entry never disappears from AD.
+    '''
+    dn = entry_dn(map_name=map_name, entry_k=entry_k)
+    old = {'nisMapEntry': [nis_map_entry(map_name=map_name,
+                                         entry_v=ad_entry_v)]}
+    new = {'nisMapEntry': [nis_map_entry(map_name=map_name,
+                                         entry_v=entry_v)]}
+
+    # modifyModlist expresses a changed value as MOD_DELETE + MOD_ADD.
+    # A single MOD_REPLACE says the same thing to AD.
+    ml = [(ldap.MOD_REPLACE, attr, vals)
+          for op, attr, vals in modlist.modifyModlist(old, new)
+          if op != ldap.MOD_DELETE]
+    if len(ml) == 0:
+        return
+
+    mod_obj(dn=dn,
+            debug_attrs=new,
+            mods=ml,
+            dry_run=dry_run)
+    return
@@ -0,0 +1,172 @@
+import os
+import json
+import sqlite3
+from amlib import conf, log, utils
+
+'''
+The on-disk snapshot of ${ampush.conf/am_container} that ad_map keeps
+between runs, as an sqlite database in ${ampush.conf/state_dir}:
+
+  meta     one row: the container, the DC it was read from, that DC's
+           invocationId and its highestCommittedUSN from just before the
+           read, and when the read was made
+  objects  one row per object in the container: objectGUID (hex), map and
+           key (lowercased; key is '' for the nisMap object itself), DN
+           and the attrs as JSON
+
+objects is indexed on (map, key), so one map can be read without loading
+the rest: that is what amcat --cached does.
+
+The file is replaced whole on every write, by rename, so readers never see
+half of one.
+
+amcat, dump_admaps and verify_admaps --cached bring it up to date too.
+That moves the watermark but can't hide a change from ampush: whether a
+map needs comparing is decided by its per-map ad_map.fingerprint() in the
+manifest, not by the watermark.
+
+Part of ampush. https://github.com/sfu-rcg/ampush
+Copyright (C) 2016-2017 Research Computing Group, Simon Fraser University.
+'''
+SCHEMA = '''
+CREATE TABLE meta (container TEXT, dc TEXT, invocation_id TEXT,
+                   usn TEXT, time REAL);
+CREATE TABLE objects (guid TEXT PRIMARY KEY, map TEXT, key TEXT,
+                      dn TEXT, attrs TEXT);
+CREATE INDEX objects_map_key ON objects (map, key);
+'''
+META = ['container', 'dc', 'invocation_id', 'usn', 'time']
+
+
+def path():
+    return utils.state_path('adstate', ext='sqlite')
+
+
+def _connect():
+    ''' Return a connection to the snapshot, or None if there isn't one. '''
+    pathname = path()
+    if utils.file_exists(pathname) is False:  # connect() would create it
+        return None
+    db = sqlite3.connect(pathname)
+    db.text_factory = str
+    return db
+
+
+def meta():
+    '''
+Return the snapshot's meta row as a dict, or None if there is no usable
+snapshot.
+    '''
+    try:
+        db = _connect()
+        if db is None:
+            return None
+        row = db.execute('SELECT {0} FROM meta'.format(
+            ', '.join(META))).fetchone()
+        db.close()
+    except sqlite3.Error as e:
+        log.m.warning('Unable to read {0}: {1}'.format(path(), e))
+        return None
+    if row is None:
+        return None
+    return dict(zip(META, row))
+
+
+def read():
+    '''
+Return meta() with 'rows' added: {guid: (dn, attrs)} for every object. None
+if there is no usable snapshot.
+    '''
+    state = meta()
+    if state is None:
+        return None
+    state['rows'] = {}
+    try:
+        db = _connect()
+        for guid, dn, attrs in db.execute(
+                'SELECT guid, dn, attrs FROM objects'):
+            state['rows'][guid] = (dn, utils.json_str(json.loads(attrs)))
+        db.close()
+    except (sqlite3.Error, ValueError) as e:
+        log.m.warning('Unable to read {0}: {1}'.format(path(), e))
+        return None
+    return state
+
+
+def map_object(map_name=None):
+    ''' Return (dn, attrs) for map_name's nisMap object, or None. '''
+    db = _connect()
+    if db is None:
+        return None
+    try:
+        row = db.execute('SELECT dn, attrs FROM objects ' +
+                         'WHERE map = ? AND key = ?',
+                         (map_name.lower(), '')).fetchone()
+    finally:
+        db.close()
+    if row is None:
+        return None
+    return row[0], utils.json_str(json.loads(row[1]))
+
+
+def map_rows(map_name=None):
+    ''' Generator. Yield (dn, attrs) for each entry of map_name, by key. '''
+    db = _connect()
+    if db is None:
+        return
+    try:
+        for dn, attrs in db.execute('SELECT dn, attrs FROM objects ' +
+                                    'WHERE map = ? AND key > ? ORDER BY key',
+                                    (map_name.lower(), '')):
+            yield dn, utils.json_str(json.loads(attrs))
+    finally:
+        db.close()
+    return
+
+
+def map_names():
+    ''' Return the cn of every nisMap in the snapshot. '''
+    db = _connect()
+    if db is None:
+        return []
+    try:
+        rows = db.execute('SELECT attrs FROM objects ' +
+                          'WHERE map IS NOT NULL AND key = ?', ('',))
+        names = [utils.json_str(json.loads(attrs))['cn'][0]
+                 for (attrs,) in rows]
+    finally:
+        db.close()
+    return names
+
+
+def write(state=None, rows=None):
+    '''
+Replace the snapshot. state has the META fields; rows are
+(guid, map, key, dn, attrs), with map and key None where they don't apply.
+Failure is logged, not fatal.
+    '''
+    pathname = path()
+    tmp = '{0}.{1}.tmp'.format(pathname, os.getpid())
+    try:
+        if not utils.file_exists(os.path.dirname(pathname)):
+            os.makedirs(os.path.dirname(pathname))
+        if utils.file_exists(tmp):
+            os.remove(tmp)
+        db = sqlite3.connect(tmp)
+        db.text_factory = str
+        db.executescript(SCHEMA)
+        db.execute('INSERT INTO meta VALUES (?, ?, ?, ?, ?)',
+                   [state[k] for k in META])
+        db.executemany('INSERT INTO objects VALUES (?, ?, ?, ?, ?)',
+                       ((guid, map_key, entry_key or '', dn,
+                         json.dumps(attrs))
+                        for guid, map_key, entry_key, dn, attrs in rows))
+        db.commit()
+        db.close()
+        os.rename(tmp, pathname)
+    except (sqlite3.Error, IOError, OSError) as e:
+        log_msg = 'Unable to write state file {0}: {1}'.format(pathname, e)
+        log.m.warning(log_msg)
+        if utils.file_exists(tmp):
+            os.remove(tmp)
+    return
@@ -28,10 +28,54 @@ p.add_argument('--sync',
                help="Push specified flat file map(s) into AD. If no " +
                     "maps are specified, push all maps on disk into AD.")
 
+p.add_argument('--full',
+               dest='full',
+               action='store_true',
+               help="Compare every map against AD, including maps that " +
+                    "haven't changed since the last push.")
+
+p.add_argument('-j', '--jobs',
+               dest='jobs',
+               action='store',
+               type=int,
+               default=1,
+               help='Sync up to this many maps at once, each with its ' +
+                    'own AD connection. Default: 1')
+
+p.add_argument('--watch',
+               dest='watch',
+               action='store_true',
+               help='Sync, then keep running and sync each flat file ' +
+                    'map again as soon as it changes.')
+
+p.add_argument('--plan',
+               dest='plan',
+               action='store',
+               metavar='FILE',
+               help='Like --dry-run, but also save every AD operation ' +
+                    'the sync would make to FILE, for review and --apply.')
+
+p.add_argument('--apply',
+               dest='apply',
+               action='store',
+               metavar='FILE',
+               help='Make the AD operations saved by --plan. Flat file ' +
+                    'maps are not read. Refuses to run if AD has changed ' +
+                    'since the plan was made.')
+
+p.add_argument('--profile',
+               dest='profile',
+               action='store',
+               metavar='DIR',
+               help='Profile the sync of each map, writing CPU and ' +
+                    'memory reports and a summary to DIR.')
+
 p.add_argument('-m', '--mode',
                dest='mode',
                action='store',
-               help='Use alternate AD OU and munging rules')
+               help='Use alternate AD OU and munging rules. Takes a ' +
+                    'comma-separated list of modes, or "all", to push ' +
+                    'to several containers at once.')
 
 p.add_argument('-s', '--source',
                dest='source',
@@ -39,8 +83,18 @@ p.add_argument('-s', '--source',
                help='Read from alternate set of flat file automount maps')
 
 
-a = vars(p.parse_args())
+a = {}  # filled in by parse()
+
 
-if len(sys.argv) <= 1:
-    p.print_help()
-    sys.exit(1)
+def parse(argv=None):
+    '''
+Parse ampush's command line into a. Only the ampush script calls this;
+the other tools have their own arguments, or none.
+    '''
+    if argv is None:
+        argv = sys.argv[1:]
+    if len(argv) < 1:
+        p.print_help()
+        sys.exit(1)
+    a.update(vars(p.parse_args(argv)))
+    return a
@@ -1,24 +1,284 @@
 """ Use python-ad and GSSAPI/Kerberos to connect to AD. """
 
 # requires python-ad: https://github.com/sfu-rcg/python-ad
+# (but not to talk to a fake_ad.FakeDirectory)
 try:
-    from ad import Client, Creds, activate
+    from ad import Creds, Locator, activate
 except ImportError:
-    raise Exception("python-ad package required.")
+    Creds = None
 
 try:
     import ldap
+    import ldap.sasl
 except ImportError:
     raise Exception("python-ldap package required.")
 
 
 
-from amlib import conf
+import time
+import threading
+from amlib import conf, log, metrics
 
-ad_user = conf.c['am_user']+'@'+conf.c['ad_domain']
-ad_pass = conf.c['am_pass']
-creds = Creds(conf.c['ad_domain'])
+'''
+Nothing here talks to AD until a connection is first used. Then:
 
-creds.acquire(principal=ad_user, password=ad_pass)
-activate(creds)
-c = Client(conf.c['ad_domain'])
+  - Kerberos credentials are acquired once per process, and again if a
+    bind fails because they've expired.
+  - Each thread gets a bound Connection from a small pool of idle ones,
+    or a new one. release() puts it back for the next thread.
+  - A Connection that finds its DC gone (SERVER_DOWN) or slow (TIMEOUT)
+    reconnects and retries, up to ${ampush.conf/ldap_retries} times.
+    It goes back to the same DC unless binding to that one fails too.
+'''
+_lock = threading.Lock()
+_local = threading.local()
+_idle = []         # bound Connections nobody is using
+_everyone = []     # every Connection, for stats()
+_creds = None
+_server = None
+_factory = None  # see use_factory()
+
+RETRY_ON = (ldap.SERVER_DOWN, ldap.TIMEOUT)
+
+# LDAPObject method: what metrics.count() calls it
+METRIC = {'search_ext': 'search', 'search_ext_s': 'search',
+          'search_s': 'search', 'add_ext': 'add', 'modify_ext': 'modify',
+          'delete_ext': 'delete'}
+
+
+def use_factory(factory=None):
+    '''
+Have Connections call factory() for an LDAPObject-like object instead of
+binding to a DC, e.g. fake_ad.FakeDirectory(...).connect.
+    '''
+    global _factory
+    _factory = factory
+    return
+
+
+def _acquire_creds(renew=False):
+    global _creds
+    if Creds is None:
+        raise Exception("python-ad package required.")
+    with _lock:
+        if _creds is None or renew is True:
+            ad_user = conf.c['am_user']+'@'+conf.c['ad_domain']
+            ad_pass = conf.c['am_pass']
+            creds = Creds(conf.c['ad_domain'])
+            creds.acquire(principal=ad_user, password=ad_pass)
+            activate(creds)
+            _creds = creds
+    return _creds
+
+
+def _locate(unreachable=None):
+    '''
+Return the DC for this process. The first one located is kept for the
+whole run: reads and writes must all see the same copy of the container.
+Only if unreachable, a DC that couldn't be bound to, is still the one in
+use is another located. With ${ampush.conf/ad_server} set, that DC is
+always used.
+    '''
+    global _server
+    with _lock:
+        if conf.c['ad_server']:
+            _server = conf.c['ad_server']
+        elif _server is None:
+            _server = Locator().locate(conf.c['ad_domain'])
+        elif unreachable is not None and unreachable == _server:
+            others = [dc for dc in Locator().locate_many(conf.c['ad_domain'])
+                      if dc != unreachable]
+            if others:
+                _server = others[0]
+                log_msg = 'DC {0} unreachable; failing over to {1}'
+                log.m.warning(log_msg.format(unreachable, _server))
+            else:
+                log_msg = 'DC {0} unreachable and no other DC found'
+                log.m.warning(log_msg.format(unreachable))
+    return _server
+
+
+def pin():
+    ''' Pick the DC now, so that processes forked from this one share it. '''
+    if _factory is None:
+        log.m.debug('Using DC ' + _locate())
+    return
+
+
+class Connection(object):
+    '''
+A python-ldap connection that binds on first use and heals itself.
+Method calls are passed through to the underlying LDAPObject, e.g.
+conn.search_ext_s(...), and timed.
+
+self.generation goes up on every reconnect. Message IDs from an older
+generation are meaningless on the current connection.
+    '''
+
+    def __init__(self):
+        self.l = None
+        self.server = None
+        self.generation = 0
+        self.ops = 0
+        self.errors = 0
+        self.reconnects = 0
+        self.seconds = 0.0
+        self.slowest = 0.0
+
+    def _bind(self, unreachable=None):
+        if _factory is not None:
+            self.server = 'fake'
+            self.l = _factory()
+            return
+        _acquire_creds()
+        self.server = _locate(unreachable=unreachable)
+        l = ldap.initialize('ldap://' + self.server)
+        l.protocol_version = 3
+        l.set_option(ldap.OPT_REFERRALS, 0)
+        l.set_option(ldap.OPT_NETWORK_TIMEOUT,
+                     float(conf.c['ldap_timeout']))
+        l.timeout = float(conf.c['ldap_timeout'])
+        try:
+            l.sasl_interactive_bind_s('', ldap.sasl.gssapi())
+        except (ldap.LOCAL_ERROR, ldap.INVALID_CREDENTIALS):
+            # most likely an expired ticket in a long-running process
+            log.m.info('Kerberos bind failed; renewing credentials')
+            _acquire_creds(renew=True)
+            l.sasl_interactive_bind_s('', ldap.sasl.gssapi())
+        self.l = l
+        return
+
+    def reset(self):
+        ''' Drop the connection. The next call reconnects. '''
+        if self.l is not None:
+            try:
+                self.l.unbind_s()
+            except ldap.LDAPError:
+                pass
+        self.l = None
+        self.generation += 1
+        return
+
+    def call(self, method=None, *args, **kwargs):
+        '''
+Call an LDAPObject method, binding first if need be. On SERVER_DOWN or
+TIMEOUT, from the call or the bind, reconnect and retry: to the same DC,
+unless it was the bind that failed.
+        '''
+        retries = int(conf.c['ldap_retries'])
+        unreachable = None
+        for attempt in range(retries + 1):
+            start = time.time()
+            try:
+                if self.l is None:  # a bind that fails is retried, too
+                    self._bind(unreachable=unreachable)
+                r = getattr(self.l, method)(*args, **kwargs)
+                if method in METRIC:
+                    metrics.count(METRIC[method])
+                if method.endswith('_s') and isinstance(r, list):
+                    metrics.count('entries', len(r))
+                return r
+            except RETRY_ON as e:
+                self.errors += 1
+                if attempt == retries:
+                    raise
+                unreachable = None
+                if self.l is None:  # the bind failed: the DC can't be reached
+                    unreachable = self.server
+                log_msg = '{0}: {1} on {2}; reconnecting (attempt {3}/{4})'
+                log.m.warning(log_msg.format(method, e.__class__.__name__,
+                                             self.server, attempt + 1,
+                                             retries))
+                self.reset()
+                self.reconnects += 1
+                time.sleep(min(2 ** attempt, 30))
+            finally:
+                took = time.time() - start
+                self.ops += 1
+                self.seconds += took
+                self.slowest = max(self.slowest, took)
+        return
+
+    def result3(self, msgid=ldap.RES_ANY, *args, **kwargs):
+        '''
+Collect a result. Unlike call(), never retried: the message ID means
+nothing to a new connection. On SERVER_DOWN or TIMEOUT the connection is
+dropped and the error raised; the caller has to send its request again.
+        '''
+        start = time.time()
+        try:
+            r = self.l.result3(msgid, *args, **kwargs)
+            if r[0] in (ldap.RES_SEARCH_ENTRY, ldap.RES_SEARCH_RESULT):
+                metrics.count('entries', len(r[1] or []))
+            return r
+        except RETRY_ON:
+            self.errors += 1
+            self.reset()
+            self.reconnects += 1
+            raise
+        finally:
+            took = time.time() - start
+            self.seconds += took
+            self.slowest = max(self.slowest, took)
+
+    def __getattr__(self, method):
+        if method.startswith('_'):
+            raise AttributeError(method)
+        return lambda *args, **kwargs: self.call(method, *args, **kwargs)
+
+    def stats(self):
+        avg = 0.0
+        if self.ops > 0:
+            avg = self.seconds / self.ops
+        return {'server': self.server,
+                'healthy': self.l is not None,
+                'ops': self.ops,
+                'errors': self.errors,
+                'reconnects': self.reconnects,
+                'avg_ms': round(avg * 1000, 1),
+                'max_ms': round(self.slowest * 1000, 1)}
+
+
+def ldap_conn():
+    '''
+Return this thread's Connection to a DC in ${conf/ad_domain}. python-ad's
+Client hides the message IDs and server controls that paged searches and
+asynchronous writes need, so ad_map and ad_op use this instead.
+    '''
+    if getattr(_local, 'conn', None) is None:
+        with _lock:
+            if _idle:
+                _local.conn = _idle.pop()
+            else:
+                _local.conn = Connection()
+                _everyone.append(_local.conn)
+    return _local.conn
+
+
+def release():
+    ''' Give this thread's Connection back to the pool. '''
+    conn = getattr(_local, 'conn', None)
+    if conn is None:
+        return
+    _local.conn = None
+    with _lock:
+        if len(_idle) < int(conf.c['ldap_pool_size']):
+            _idle.append(conn)
+            return
+    conn.reset()
+    return
+
+
+def stats():
+    ''' Health and latency of every connection made so far. '''
+    with _lock:
+        return [conn.stats() for conn in _everyone]
+
+
+def log_stats():
+    for s in stats():
+        log_msg = ('cnx {server}: {ops} ops, avg {avg_ms}ms, '
+                   'max {max_ms}ms, {errors} errors, '
+                   '{reconnects} reconnects').format(**s)
+        log.m.debug(log_msg)
+    return
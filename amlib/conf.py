@@ -1,37 +1,88 @@
 import os
 from ConfigParser import ConfigParser
-from amlib import argp
-
-tmp_conf = ConfigParser()
-tmp_path = os.path.dirname(os.path.abspath(__file__))  # /base/lib/here
-tmp_path = tmp_path.split('/')
-conf_path = '/'.join(tmp_path[0:-1])   # /base/lib
-tmp_conf.read(conf_path+'/ampush.conf')
-c = {}
-c.update(tmp_conf.items('default'))
-
-# select target AD container: default or user-specified with --mode?
-if argp.a['mode'] is not None:
-    try:
-        container_conf_key = 'am_container_' + argp.a['mode']
-        c['am_container'] = c[container_conf_key]
-    except KeyError:
-        log_msg = 'Terminating. No such parameter in ampush.conf: ' + \
-                  container_conf_key
-        raise Exception(log_msg)
-else:
-    c['am_container'] = c['am_container_default']
-
-
-# select alternate flat file automount maps: default or user-specified
-# set passed via --source?
-if argp.a['source'] is not None:
-    try:
-        ff_map_dir_conf_key = 'flat_file_map_dir_' + argp.a['source']
-        c['flat_file_map_dir'] = c[ff_map_dir_conf_key]
-    except KeyError:
-        log_msg = 'Terminating. No such parameter in ampush.conf: ' + \
-                  ff_map_dir_conf_key
-        raise Exception(log_msg)
-else:
-    c['flat_file_map_dir'] = c['flat_file_map_dir_default']
+
+# optional settings; ampush.conf overrides these
+defaults = {
+    'replication_batch_size': '0',
+    'ldap_page_size': '1000',
+    'ldap_window': '32',
+    'ldap_timeout': '30',
+    'ldap_retries': '3',
+    'ldap_pool_size': '4',
+    'state_dir': '/var/lib/ampush',
+    'snapshot_max_age': '86400',
+    'metrics_textfile_dir': '',
+    'check_hostnames': '1',
+    'dns_jobs': '16',
+    'dns_timeout': '10',
+    'dns_cache_ttl': '3600',
+    'watch_debounce': '2',
+    'watch_interval': '10',
+    'ad_server': '',
+    'replication_confirm': '0',
+    'replication_confirm_delay': '0.05',
+}
+
+c = {}  # filled in by load()
+
+
+def load(mode=None, source=None):
+    '''
+Read ampush.conf into c. mode and source are ampush's --mode and --source:
+pick the AD container(s) and the set of flat file maps to use.
+    '''
+    tmp_conf = ConfigParser(defaults)
+    tmp_path = os.path.dirname(os.path.abspath(__file__))  # /base/lib/here
+    tmp_path = tmp_path.split('/')
+    conf_path = '/'.join(tmp_path[0:-1])   # /base/lib
+    tmp_conf.read(conf_path+'/ampush.conf')
+    c.clear()
+    c.update(tmp_conf.items('default'))
+
+    # select target AD container(s): default or user-specified with --mode?
+    # --mode takes one mode, a comma-separated list of modes, or "all".
+    # None == the default container.
+    if mode is None:
+        c['modes'] = [None]
+    elif mode == 'all':
+        c['modes'] = [None]
+        for k in sorted(c.keys()):
+            if k.startswith('am_container_') and \
+               k != 'am_container_default':
+                c['modes'].append(k[len('am_container_'):])
+    else:
+        c['modes'] = mode.split(',')
+
+    for m in c['modes']:  # catch typos before anything happens
+        use_mode(m)
+    use_mode(c['modes'][0])
+
+    # select alternate flat file automount maps: default or user-specified
+    # set passed via --source?
+    if source is not None:
+        try:
+            ff_map_dir_conf_key = 'flat_file_map_dir_' + source
+            c['flat_file_map_dir'] = c[ff_map_dir_conf_key]
+        except KeyError:
+            log_msg = 'Terminating. No such parameter in ampush.conf: ' + \
+                      ff_map_dir_conf_key
+            raise Exception(log_msg)
+    else:
+        c['flat_file_map_dir'] = c['flat_file_map_dir_default']
+    return c
+
+
+def use_mode(mode=None):
+    ''' Point c['am_container'] at the AD container for mode. '''
+    if mode is not None:
+        try:
+            container_conf_key = 'am_container_' + mode
+            c['am_container'] = c[container_conf_key]
+        except KeyError:
+            log_msg = 'Terminating. No such parameter in ampush.conf: ' + \
+                      container_conf_key
+            raise Exception(log_msg)
+    else:
+        c['am_container'] = c['am_container_default']
+    c['mode'] = mode
+    return
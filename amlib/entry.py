@@ -0,0 +1,102 @@
+'''
+Records for parsed automount map entries, shared by file_map and ad_map.
+Part of ampush. https://github.com/sfu-rcg/ampush
+Copyright (C) 2016-2017 Research Computing Group, Simon Fraser University.
+'''
+
+try:
+    intern
+except NameError:  # python 3
+    from sys import intern
+
+
+def _intern(in_str):
+    '''
+Mount options and hostnames repeat across thousands of entries; keep one
+copy of each.
+    '''
+    if type(in_str) is str:
+        return intern(in_str)
+    return in_str
+
+
+class _Entry(object):
+    '''
+Small fixed-field record that can be used like the dicts it replaces:
+e['options'], e.get('options'), e['options'] = ..., 'options' in e,
+e.items() and comparison with a dict or another entry all work, so
+hook.munge doesn't need to know the difference.
+    '''
+    __slots__ = ()
+    __hash__ = None
+
+    def __getitem__(self, k):
+        if k not in self.__slots__:
+            raise KeyError(k)
+        return getattr(self, k)
+
+    def __setitem__(self, k, v):
+        if k not in self.__slots__:
+            raise KeyError(k)
+        setattr(self, k, v)
+
+    def __contains__(self, k):
+        return k in self.__slots__
+
+    def __iter__(self):
+        return iter(self.__slots__)
+
+    def get(self, k, default=None):
+        if k not in self.__slots__:
+            return default
+        return getattr(self, k)
+
+    def keys(self):
+        return list(self.__slots__)
+
+    def items(self):
+        return [(k, getattr(self, k)) for k in self.__slots__]
+
+    def as_dict(self):
+        return dict(self.items())
+
+    def __eq__(self, other):
+        if isinstance(other, _Entry):
+            return self.items() == other.items()
+        if isinstance(other, dict):
+            return self.as_dict() == other
+        return NotImplemented
+
+    def __ne__(self, other):
+        eq = self.__eq__(other)
+        if eq is NotImplemented:
+            return eq
+        return not eq
+
+    def __repr__(self):
+        return repr(self.as_dict())
+
+
+class MapEntry(_Entry):
+    ''' One entry of a submap or the direct map. '''
+    __slots__ = ('server_hostname', 'server_dir', 'options')
+
+    def __init__(self, server_hostname=None, server_dir=None, options=None):
+        self.server_hostname = _intern(server_hostname)
+        self.server_dir = server_dir
+        self.options = _intern(options)
+
+    def copy(self):
+        return MapEntry(self.server_hostname, self.server_dir, self.options)
+
+
+class MasterEntry(_Entry):
+    ''' One entry of the master map. '''
+    __slots__ = ('map', 'options')
+
+    def __init__(self, map=None, options=None):
+        self.map = _intern(map)
+        self.options = _intern(options)
+
+    def copy(self):
+        return MasterEntry(self.map, self.options)
@@ -0,0 +1,444 @@
+import os
+import re
+import time
+import random
+import pickle
+import binascii
+import threading
+import collections
+import ldap
+from ldap.controls import SimplePagedResultsControl
+
+'''
+An in-memory stand-in for Active Directory, for benchmarks. Not for
+production, obviously.
+
+FakeDirectory holds the objects; connect() returns a FakeLDAP, which
+answers the subset of python-ldap's LDAPObject that ad_map and ad_op use.
+Plug it in with cnx.use_factory(directory.connect).
+
+It keeps uSNChanged, tombstones (for the show-deleted control), paged
+searches and the root DSE, so incremental reads work as they do against
+a DC. It can also be made slow:
+
+  latency:  seconds each operation takes to come back. Asynchronous
+            operations overlap, as they would on the wire.
+  lag:      seconds before a simulated second DC's copy of a new object
+            replicates in.
+  cnf_rate: fraction of adds that the second DC also makes. Each one turns
+            into a "name\\0ACNF:guid" conflict object after lag seconds.
+
+Part of ampush. https://github.com/sfu-rcg/ampush
+Copyright (C) 2016-2017 Research Computing Group, Simon Fraser University.
+'''
+SHOW_DELETED_OID = '1.2.840.113556.1.4.417'
+NC = 'DC=bench,DC=example,DC=com'
+DELETED = 'CN=Deleted Objects,' + NC
+DSA = 'CN=NTDS Settings,CN=FAKEDC,CN=Servers,CN=Default-First-Site,' + \
+      'CN=Sites,CN=Configuration,' + NC
+
+_rdn_split = re.compile(r'(?<!\\),')
+
+
+def _parent(dn):
+    parts = _rdn_split.split(dn, 1)
+    if len(parts) < 2:
+        return None
+    return parts[1]
+
+
+class FakeDirectory(object):
+
+    def __init__(self, container=None, latency=0.0, lag=0.0, cnf_rate=0.0,
+                 seed=0):
+        self.latency = latency
+        self.lag = lag
+        self.cnf_rate = cnf_rate
+        self.random = random.Random(seed)
+        self.usn = 1000
+        self.invocation_id = self._guid()
+        self.objects = {}      # lowercased dn: (dn, attrs)
+        self.children = collections.defaultdict(int)  # lowercased dn: n
+        self.replicating = []  # (due time, dn, attrs) from the "other DC"
+        self.counts = collections.defaultdict(int)
+        self.lock = threading.Lock()
+        for dn in [NC, DELETED, DSA, container]:
+            self._ensure(dn)
+        self.objects[DSA.lower()][1]['invocationId'] = [self.invocation_id]
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state['lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.lock = threading.Lock()
+
+    def save(self, pathname=None):
+        f = open(pathname, 'wb')
+        pickle.dump(self, f, 2)
+        f.close()
+        return
+
+    def connect(self):
+        return FakeLDAP(directory=self)
+
+    def _guid(self):
+        return ''.join(chr(self.random.randint(0, 255)) for i in range(16))
+
+    def _ensure(self, dn=None):
+        ''' Create dn and any missing parents, with no questions asked. '''
+        if dn is None or dn.lower() in self.objects:
+            return
+        self._ensure(_parent(dn))
+        rdn = _rdn_split.split(dn, 1)[0]
+        self._store(dn, {'objectClass': ['top', 'container'],
+                         'cn': [rdn.split('=', 1)[1]]})
+        return
+
+    def _store(self, dn=None, attrs=None):
+        self.usn += 1
+        attrs['uSNChanged'] = [str(self.usn)]
+        attrs.setdefault('objectGUID', [self._guid()])
+        if dn.lower() not in self.objects and _parent(dn) is not None:
+            self.children[_parent(dn).lower()] += 1
+        self.objects[dn.lower()] = (dn, attrs)
+        return
+
+    def _remove(self, dn=None):
+        self.children[_parent(dn).lower()] -= 1
+        return self.objects.pop(dn.lower())
+
+    def _replicate(self):
+        ''' Let the other DC's overdue writes arrive. '''
+        now = time.time()
+        while self.replicating and self.replicating[0][0] <= now:
+            due, dn, attrs = self.replicating.pop(0)
+            guid = self._guid()
+            h = binascii.hexlify(guid)
+            hex_guid = '-'.join([h[0:8], h[8:12], h[12:16], h[16:20],
+                                 h[20:32]])
+            rdn, parent = _rdn_split.split(dn, 1)
+            name = rdn.split('=', 1)[1]
+            cnf_dn = '{0}\\0ACNF:{1},{2}'.format(rdn, hex_guid, parent)
+            attrs = dict(attrs)
+            attrs['cn'] = [name + '\nCNF:' + hex_guid]
+            attrs['objectGUID'] = [guid]
+            if parent.lower() in self.objects:
+                self._store(cnf_dn, attrs)
+        return
+
+    def do(self, op=None, dn=None, args=None):
+        ''' Make one write. Return the LDAPError it fails with, or None. '''
+        with self.lock:
+            self._replicate()
+            self.counts[op] += 1
+            key = dn.lower()
+            if op == 'add':
+                if key in self.objects:
+                    return ldap.ALREADY_EXISTS({'desc': 'Already exists',
+                                                'info': dn})
+                if _parent(dn).lower() not in self.objects:
+                    return ldap.NO_SUCH_OBJECT({'desc': 'No such object',
+                                                'info': dn})
+                attrs = dict((a, list(v)) for a, v in args)
+                self._store(dn, attrs)
+                if self.random.random() < self.cnf_rate:
+                    self.replicating.append((time.time() + self.lag, dn,
+                                             dict(attrs)))
+                return None
+
+            if key not in self.objects:
+                return ldap.NO_SUCH_OBJECT({'desc': 'No such object',
+                                            'info': dn})
+            if op == 'modify':
+                attrs = dict(self.objects[key][1])
+                for mod_op, attr, v in args:
+                    if mod_op == ldap.MOD_DELETE:
+                        attrs.pop(attr, None)
+                    elif mod_op == ldap.MOD_ADD:
+                        attrs[attr] = attrs.get(attr, []) + list(v)
+                    else:
+                        attrs[attr] = list(v)
+                self._store(self.objects[key][0], attrs)
+                return None
+
+            # delete: leaves only, leaving a tombstone behind
+            if self.children[key] > 0:
+                return ldap.NOT_ALLOWED_ON_NONLEAF(
+                    {'desc': 'Operation not allowed on non-leaf',
+                     'info': dn})
+            dn, attrs = self._remove(dn)
+            tomb = 'CN=DEL:{0},{1}'.format(self.usn + 1, DELETED)
+            self._store(tomb, {'objectGUID': attrs['objectGUID'],
+                               'isDeleted': ['TRUE']})
+            return None
+
+    def search(self, base=None, scope=ldap.SCOPE_SUBTREE,
+               filterstr='(objectClass=*)', attrs=None,
+               show_deleted=False):
+        ''' Return [(dn, attrs)], or the LDAPError the search fails with. '''
+        with self.lock:
+            self._replicate()
+            self.counts['search'] += 1
+            if base == '':
+                return [('', self._root_dse())]
+            key = base.lower()
+            if key not in self.objects:
+                return ldap.NO_SUCH_OBJECT({'desc': 'No such object',
+                                            'info': base})
+            if scope == ldap.SCOPE_BASE:
+                candidates = [self.objects[key]]
+            else:
+                suffix = ',' + key
+                depth = key.count(',') + 1
+                candidates = [v for k, v in self.objects.items()
+                              if k == key or k.endswith(suffix)]
+                if scope == ldap.SCOPE_ONELEVEL:
+                    candidates = [v for v in candidates
+                                  if v[0].count(',') == depth]
+            match = _filter(filterstr)
+            out = []
+            for dn, entry in sorted(candidates):
+                if 'isDeleted' in entry and show_deleted is False:
+                    continue
+                if match(entry):
+                    out.append((dn, _select(entry, attrs)))
+            return out
+
+    def _root_dse(self):
+        return {'highestCommittedUSN': [str(self.usn)],
+                'dsServiceName': [DSA],
+                'dnsHostName': ['fakedc.bench.example.com'],
+                'defaultNamingContext': [NC]}
+
+
+def load(pathname=None):
+    f = open(pathname, 'rb')
+    directory = pickle.load(f)
+    f.close()
+    return directory
+
+
+def _select(entry=None, attrs=None):
+    if attrs is None:
+        return dict(entry)
+    wanted = set(a.lower() for a in attrs)
+    return dict((k, v) for k, v in entry.items() if k.lower() in wanted)
+
+
+def _filter(filterstr=None):
+    '''
+Compile an LDAP filter into a predicate on an attrs dict. Handles &, |,
+!, presence, equality with * wildcards, >= and <= (numeric), which is
+all ampush asks for.
+    '''
+    predicate, rest = _parse(filterstr.strip())
+    return predicate
+
+
+def _parse(s):
+    if not s.startswith('('):
+        raise ldap.FILTER_ERROR({'desc': 'Bad search filter', 'info': s})
+    s = s[1:]
+    if s[0] in '&|':
+        subs = []
+        op, s = s[0], s[1:]
+        while s.startswith('('):
+            sub, s = _parse(s)
+            subs.append(sub)
+        if op == '&':
+            return (lambda e: all(f(e) for f in subs)), s[1:]
+        return (lambda e: any(f(e) for f in subs)), s[1:]
+    if s[0] == '!':
+        sub, s = _parse(s[1:])
+        return (lambda e: not sub(e)), s[1:]
+
+    end = s.index(')')
+    item, s = s[:end], s[end + 1:]
+    attr, op, value = re.match(r'([^=<>]+)(>=|<=|=)(.*)', item).groups()
+    value = re.sub(r'\\([0-9a-fA-F]{2})',
+                   lambda m: chr(int(m.group(1), 16)), value)
+    attr = attr.lower()
+
+    def values(e):
+        for k, v in e.items():
+            if k.lower() == attr:
+                return v
+        return []
+
+    if op == '>=':
+        return (lambda e: any(int(v) >= int(value) for v in values(e))), s
+    if op == '<=':
+        return (lambda e: any(int(v) <= int(value) for v in values(e))), s
+    if value == '*':
+        return (lambda e: len(values(e)) > 0), s
+    pattern = re.compile('^' + '.*'.join(re.escape(p)
+                                         for p in value.split('*')) + '$',
+                         re.IGNORECASE | re.DOTALL)
+    return (lambda e: any(pattern.match(v) for v in values(e))), s
+
+
+class FakeLDAP(object):
+    '''
+One connection to a FakeDirectory. Writes happen when they're sent;
+their results (and each page of a search) come back latency seconds
+later.
+    '''
+
+    def __init__(self, directory=None):
+        self.directory = directory
+        self.protocol_version = 3
+        self.timeout = -1
+        self.msgid = 0
+        self.results = {}  # msgid: (ready at, result type, data or error)
+        self.paged = {}    # cookie: rows of a paged search not sent yet
+
+    def set_option(self, option=None, value=None):
+        return
+
+    def unbind_s(self):
+        return
+
+    def _queue(self, rtype=None, data=None, ctrls=None):
+        self.msgid += 1
+        self.results[self.msgid] = (time.time() + self.directory.latency,
+                                    rtype, data, ctrls or [])
+        return self.msgid
+
+    def _wait(self):
+        if self.directory.latency > 0:
+            time.sleep(self.directory.latency)
+        return
+
+    def add_ext(self, dn=None, modlist=None, *args, **kwargs):
+        return self._queue(ldap.RES_ADD,
+                           self.directory.do(op='add', dn=dn, args=modlist))
+
+    def modify_ext(self, dn=None, modlist=None, *args, **kwargs):
+        return self._queue(ldap.RES_MODIFY,
+                           self.directory.do(op='modify', dn=dn,
+                                             args=modlist))
+
+    def delete_ext(self, dn=None, *args, **kwargs):
+        return self._queue(ldap.RES_DELETE,
+                           self.directory.do(op='delete', dn=dn))
+
+    def search_ext(self, base=None, scope=ldap.SCOPE_SUBTREE,
+                   filterstr='(objectClass=*)', attrlist=None,
+                   attrsonly=0, serverctrls=None, *args, **kwargs):
+        paged, show_deleted = None, False
+        for ctrl in serverctrls or []:
+            if ctrl.controlType == SimplePagedResultsControl.controlType:
+                paged = ctrl
+            elif ctrl.controlType == SHOW_DELETED_OID:
+                show_deleted = True
+
+        if paged is not None and paged.cookie:
+            rows = self.paged.pop(paged.cookie)
+        else:
+            rows = self.directory.search(base, scope, filterstr, attrlist,
+                                         show_deleted=show_deleted)
+        if isinstance(rows, ldap.LDAPError) or paged is None:
+            return self._queue(ldap.RES_SEARCH_RESULT, rows)
+
+        cookie = ''
+        if len(rows) > paged.size:
+            cookie = 'page{0}'.format(self.msgid + 1)
+            self.paged[cookie] = rows[paged.size:]
+        ctrl = SimplePagedResultsControl(True, size=paged.size,
+                                         cookie=cookie)
+        return self._queue(ldap.RES_SEARCH_RESULT, rows[:paged.size], [ctrl])
+
+    def result3(self, msgid=ldap.RES_ANY, *args, **kwargs):
+        ready, rtype, data, ctrls = self.results.pop(msgid)
+        delay = ready - time.time()
+        if delay > 0:
+            time.sleep(delay)
+        if isinstance(data, ldap.LDAPError):
+            raise data
+        return rtype, data or [], msgid, ctrls
+
+    def search_ext_s(self, base=None, scope=ldap.SCOPE_SUBTREE,
+                     filterstr='(objectClass=*)', attrlist=None,
+                     *args, **kwargs):
+        self._wait()
+        rows = self.directory.search(base, scope, filterstr, attrlist)
+        if isinstance(rows, ldap.LDAPError):
+            raise rows
+        return rows
+
+    def search_s(self, base=None, scope=ldap.SCOPE_SUBTREE,
+                 filterstr='(objectClass=*)', attrlist=None,
+                 *args, **kwargs):
+        return self.search_ext_s(base, scope, filterstr, attrlist)
+
+
+'''
+Synthetic flat file maps to feed it.
+'''
+OPTIONS = ['-rw,intr,soft,bg', '-ro,intr,soft,bg', '-rw,tcp,vers=3',
+           '-rw,intr,vers=4,sec=krb5', '-nosuid,tcp,intr,bg,vers=3,rw']
+
+
+def _map_line(rnd=None, map_no=None, key=None):
+    host = 'nfs{0}.bench.example.com'.format(rnd.randint(0, 15))
+    line = '{0}\t{1}\t{2}:/export/bench{3}/{0}'
+    return line.format(key, rnd.choice(OPTIONS), host, map_no)
+
+
+def write_maps(pathname=None, maps=10, entries=1000, seed=0):
+    '''
+Write auto.master and maps submaps (auto.bench0...) of entries entries
+each into directory pathname.
+    '''
+    rnd = random.Random(seed)
+    if not os.path.isdir(pathname):
+        os.makedirs(pathname)
+    master = []
+    for i in range(maps):
+        map_name = 'auto.bench{0}'.format(i)
+        master.append('/bench{0}\t{1}\t-rw,intr,soft'.format(i, map_name))
+        f = open(os.path.join(pathname, map_name), 'w')
+        for j in range(entries):
+            key = 'key{0}'.format(j)
+            f.write(_map_line(rnd=rnd, map_no=i, key=key) + '\n')
+        f.close()
+    f = open(os.path.join(pathname, 'auto.master'), 'w')
+    f.write('\n'.join(master) + '\n')
+    f.close()
+    return
+
+
+def change_maps(pathname=None, fraction=0.1, seed=1):
+    '''
+Rewrite about fraction of the entries in every submap in pathname: a third
+get new values, a third are removed and a third are replaced by new keys.
+    '''
+    rnd = random.Random(seed)
+    for map_name in sorted(os.listdir(pathname)):
+        if not map_name.startswith('auto.bench'):
+            continue
+        map_no = int(map_name[len('auto.bench'):])
+        f = open(os.path.join(pathname, map_name))
+        lines = f.read().splitlines()
+        f.close()
+
+        out = []
+        for n, line in enumerate(lines):
+            roll = rnd.random()
+            key = line.split()[0]
+            if roll < fraction / 3:
+                out.append(_map_line(rnd=rnd, map_no=map_no, key=key))
+            elif roll < fraction * 2 / 3:
+                continue
+            elif roll < fraction:
+                key = 'new{0}'.format(n)
+                out.append(_map_line(rnd=rnd, map_no=map_no, key=key))
+            else:
+                out.append(line)
+        f = open(os.path.join(pathname, map_name), 'w')
+        f.write('\n'.join(out) + '\n')
+        f.close()
+    return
@@ -1,6 +1,7 @@
 import os
 import re
 from amlib import conf, utils, log
+from amlib.entry import MapEntry, MasterEntry
 
 '''
 Functions for parsing AD automount maps into a common dict format.
@@ -10,17 +11,60 @@ Copyright (C) 2016 Research Computing Group, Simon Fraser University.
 
 # ff = flat file automount map
 
+'''
+A whole submap entry in one match: key, optional mount options (which
+must start with '-') and server:path. Lines it doesn't match are left to
+_parse_submap_line(), whose step-by-step checks give bad entries their
+usual error messages and exit codes.
+'''
+_SUBMAP_ENTRY = re.compile(r'\s*(\S+)\s+(?:(-\S*)\s+)?([^\s:]*):([^\s:]*)\s*$')
+
+'''
+Caches, so that each directory is walked and each map parsed once per run
+however often they're asked for. A listing is reused while the mtime of
+every directory in it is unchanged, a parsed map while its file's mtime
+and size are.
+'''
+_listings = {}  # map dir: ([(dirpath, mtime), ...], [filename, ...])
+_parsed = {}    # map pathname: ((mtime, size), parsed map)
+
+
+def _stat(pathname=None):
+    ''' Return (mtime, size) of pathname, or None if it isn't there. '''
+    try:
+        st = os.stat(pathname)
+    except OSError:
+        return None
+    return st.st_mtime, st.st_size
+
+
+def _filenames():
+    ''' Return the names of all files under ${conf/flat_file_map_dir}. '''
+    map_dir = conf.c['flat_file_map_dir']
+    cached = _listings.get(map_dir)
+    if cached is not None:
+        dirs, filenames = cached
+        if all([(_stat(d) or (None, None))[0] == mtime
+                for d, mtime in dirs]):
+            return filenames
+
+    dirs, filenames = [], []
+    for root, subdirs, names in os.walk(map_dir):
+        st = _stat(root)
+        if st is not None:
+            dirs.append((root, st[0]))
+        filenames.extend(names)
+    _listings[map_dir] = (dirs, filenames)
+    return filenames
+
+
 def get_names():
     '''
 Return a list of files in ${conf/flat_file_map_dir} with the master map and
 (optional) direct map first.
     '''
 
-    l_names, fs_map_names = [], []
-
-    for root, dirs, filenames in os.walk(conf.c['flat_file_map_dir']):
-        for map_name in filenames:
-            fs_map_names.append(map_name)
+    l_names, fs_map_names = [], list(_filenames())
 
     # ensure the master map and direct map (if one exists) are processed first
     l_names.append(conf.c['master_map_name'])
@@ -84,6 +128,8 @@ Ingest master map as a list of strings. Return a nice dict like this:
  '/bar': {'map': 'auto.bar', 'options': '-rw,intr,soft,bg'},
  '/baz': {'map': 'auto.baz',
       'options': '-ro,int,soft,bg,fstype=nfs4,port=2049'},}
+
+The values are entry.MasterEntry records, which behave like these dicts.
     '''
     d_map = {}
 
@@ -91,21 +137,19 @@ Ingest master map as a list of strings. Return a nice dict like this:
         chunks = l.split()
         am_key = chunks[0]
         joined = ' '.join(chunks)
-        d_map[am_key] = {}
         '''
 As with submaps the mount options field is optional.
 2 fields == automount entry without mount options.
         '''
         if len(chunks) == 2:
-            d_map[am_key] = {'map': chunks[1]}
+            d_map[am_key] = MasterEntry(map=chunks[1])
             log_msg = 'No mount options for {0} in {1}'
             log_msg = log_msg.format(am_key, conf.c['master_map_name'])
             log.m.info(log_msg)
 
         # 3 fields? automount directory + mapname + mount options
         elif len(chunks) == 3:
-            d_map[am_key] = {'map': chunks[1],
-                             'options': chunks[2]}
+            d_map[am_key] = MasterEntry(map=chunks[1], options=chunks[2])
 
         else:
             log_msg = (
@@ -128,6 +172,8 @@ Ingest a list of automount map entries. Return a nice dict like this:
  'luma': {'options':         '-nosuid,tcp,intr,bg,vers=3,rw',
           'server_dir':      '/exports/luma',
           'server_hostname': 'nfssrv02.example.com'}, ...}
+
+The values are entry.MapEntry records, which behave like these dicts.
 '''
     d_map = {}
 
@@ -135,50 +181,65 @@ Ingest a list of automount map entries. Return a nice dict like this:
                                        map_name)
     log.m.debug(log_msg)
 
+    match = _SUBMAP_ENTRY.match
     for l in map_lines:
-        chunks = l.split()
-        am_key = chunks[0]  # automount key
-        utils.validate_nis_map_entry(in_list=chunks[1:],
-                                     map_name=map_name,
-                                     am_key=am_key,
-                                     map_type='flat file')
-        d_map[am_key] = {}
+        m = match(l)
+        if m is None:
+            am_key, entry = _parse_submap_line(map_name=map_name, line=l)
+            d_map[am_key] = entry
+            continue
+        am_key, options, server_hostname, server_dir = m.groups()
+        d_map[am_key] = MapEntry(server_hostname, server_dir, options)
+    return d_map
 
-        '''
+
+def _parse_submap_line(map_name=None, line=None):
+    ''' Return (key, entry) for a line _SUBMAP_ENTRY didn't match. '''
+    chunks = line.split()
+    am_key = chunks[0]  # automount key
+    utils.validate_nis_map_entry(in_list=chunks[1:],
+                                 map_name=map_name,
+                                 am_key=am_key,
+                                 map_type='flat file')
+
+    '''
 Consider these two valid automount entries:
     apps -tcp,vers=3 nfs-server1.example.com:/exports/apps
     data nfs-server2.example.com:/srv/data
 
 If a third field exists, use it as the NFS path.
 Otherwise use the second field as the NFS path.
-        '''
+    '''
 
-        try:  # server:path pair with options
-            server_hostname = chunks[2].split(':')[0]
-            server_dir = chunks[2].split(':')[1]
-            options = chunks[1]
-            utils.validate_mount_options(opt_str=options,
-                                         map_name=map_name,
-                                         am_key=am_key)
-            d_map[am_key] = {'server_hostname': server_hostname,
-                             'server_dir': server_dir,
-                             'options': options}
-        except IndexError:  # without options
-            server_hostname = chunks[1].split(':')[0]
-            server_dir = chunks[1].split(':')[1]
-            d_map[am_key] = {'server_hostname': server_hostname,
-                             'server_dir': server_dir,
-                             'options': None}
-    return d_map
+    try:  # server:path pair with options
+        server_hostname = chunks[2].split(':')[0]
+        server_dir = chunks[2].split(':')[1]
+        options = chunks[1]
+        utils.validate_mount_options(opt_str=options,
+                                     map_name=map_name,
+                                     am_key=am_key)
+        return am_key, MapEntry(server_hostname, server_dir, options)
+    except IndexError:  # without options
+        server_hostname = chunks[1].split(':')[0]
+        server_dir = chunks[1].split(':')[1]
+        return am_key, MapEntry(server_hostname, server_dir, None)
 
 
 def parse(map_name=None):
     '''
 Read flat file automount maps ${ampush.conf/flat_file_map_dir} and
 pass map names to parser_master_map or parse_submap.
+
+The parsed map is cached and shared by every caller: copy it before
+changing it (sync.ff_map_copy does).
     '''
 
     map_pathname = conf.c['flat_file_map_dir'] + '/' + map_name
+    st = _stat(map_pathname)
+    cached = _parsed.get(map_pathname)
+    if st is not None and cached is not None and cached[0] == st:
+        return cached[1]
+
     map_lines = utils.ff_map_to_list(map_pathname)
     map_type = 'flat file'
 
@@ -193,4 +254,6 @@ pass map names to parser_master_map or parse_submap.
                              map_lines=map_lines)
         utils.submap_sanity_checks(map_dict=d_map,
                                    map_type=map_type)
+    if st is not None:
+        _parsed[map_pathname] = (st, d_map)
     return d_map
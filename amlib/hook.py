@@ -25,5 +25,13 @@ def munge(map_name=None, map_meat=None):
      'installers': {'options': '-intr,vers=4,port=2049,timeo=10,sec=krb5i',
                     'server_dir': '/isos',
                     'server_hostname': 'svm-nfs1.example.com}, ...}
+
+    Each value is an amlib.entry.MapEntry (MasterEntry for auto.master).
+    Read and assign its fields as you would a dict's: v['options'] = '-ro'.
+    Plain dicts work too if you add entries of your own.
+
+    conf.c['mode'] = the --mode being pushed, or None for the default
+    container. With several modes, munge runs once per mode, each time on
+    its own copy of the flat file maps.
     '''
     return map_meat  # dict
@@ -1,6 +1,6 @@
 import logging
 from logging import handlers
-import sys, utils, conf
+import sys, threading, conf
 from datetime import datetime
 
 '''
@@ -9,18 +9,71 @@ Copyright (C) 2016-2017 Research Computing Group, Simon Fraser University.
 '''
 
 
-# m = main log
+# m = main log. Nothing is written anywhere until setup() is called.
 m = logging.getLogger('main')
-m_handler = logging.FileHandler(filename=conf.c['main_logfile'])
-m.setLevel(int(conf.c['main_loglevel'])-1)  # INFO and above
 fmt = logging.Formatter(fmt='%(asctime)s %(message)s',
                         datefmt='%b %e %Y %H:%M:%S')
-m_handler.setFormatter(fmt)
-m.addHandler(m_handler)
-
-# log to stdout, too
-# hat tip: https://stackoverflow.com/a/14058475
-cons = logging.StreamHandler(sys.stdout)
-cons.setLevel(int(conf.c['main_loglevel'])-1)
-cons.setFormatter(fmt)
-m.addHandler(cons)
+
+
+def setup(logfile=True, stream=None):
+    '''
+Log to ${ampush.conf/main_logfile} and stdout at ${ampush.conf/main_loglevel}
+and above. Tools that only read flat files pass logfile=False; tools whose
+stdout is data pass stream=sys.stderr.
+    '''
+    level = int(conf.c['main_loglevel'])-1  # INFO and above
+    m.setLevel(level)
+    if logfile is True:
+        m_handler = logging.FileHandler(filename=conf.c['main_logfile'])
+        m_handler.setFormatter(fmt)
+        m.addHandler(m_handler)
+
+    # log to stdout, too
+    # hat tip: https://stackoverflow.com/a/14058475
+    cons = logging.StreamHandler(stream or sys.stdout)
+    cons.setLevel(level)
+    cons.setFormatter(fmt)
+    m.addHandler(cons)
+    return
+
+
+def tag(prefix=None):
+    ''' Put prefix, e.g. the --mode being pushed, on every line. '''
+    tagged = logging.Formatter(fmt='%(asctime)s ' + prefix + ' %(message)s',
+                               datefmt='%b %e %Y %H:%M:%S')
+    for handler in m.handlers:
+        handler.setFormatter(tagged)
+    return
+
+
+'''
+Concurrent syncs (--jobs) would interleave every map's log lines. Between
+hold() and release(), the calling thread's records are kept back and then
+emitted together.
+'''
+_held = threading.local()
+_release_lock = threading.Lock()
+
+
+class _Holder(logging.Filter):
+    def filter(self, record):
+        records = getattr(_held, 'records', None)
+        if records is None:
+            return True
+        records.append(record)
+        return False
+
+m.addFilter(_Holder())
+
+
+def hold():
+    _held.records = []
+    return
+
+
+def release():
+    records, _held.records = _held.records, None
+    with _release_lock:
+        for record in records:
+            m.handle(record)
+    return
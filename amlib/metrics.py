@@ -0,0 +1,165 @@
+import os
+import time
+import threading
+from contextlib import contextmanager
+from amlib import conf, log
+
+'''
+Per-map, per-phase counters for a run: LDAP operations, entries returned,
+replication wait and wall time. Written at the end of each mode's run
+as JSON (${ampush.conf/state_dir}) and, if
+${ampush.conf/metrics_textfile_dir} is set, as a Prometheus
+node_exporter textfile.
+
+Part of ampush. https://github.com/sfu-rcg/ampush
+Copyright (C) 2016-2017 Research Computing Group, Simon Fraser University.
+'''
+_lock = threading.Lock()
+_local = threading.local()  # .map_name, .phase: where the counts go
+_counts = {}                # (map name, phase): {metric: value}
+_started = time.time()
+
+'''
+metric: (Prometheus name, extra label or None, help). Counts whose metric
+isn't listed here still go into the JSON.
+'''
+PROM = {
+    'search': ('ampush_ldap_operations', 'op="search"',
+               'LDAP operations made during the last run'),
+    'add': ('ampush_ldap_operations', 'op="add"', None),
+    'modify': ('ampush_ldap_operations', 'op="modify"', None),
+    'delete': ('ampush_ldap_operations', 'op="delete"', None),
+    'entries': ('ampush_ldap_entries', None,
+                'Entries returned by LDAP searches during the last run'),
+    'write_errors': ('ampush_write_errors', None,
+                     'Writes refused by AD during the last run'),
+    'sleep_seconds': ('ampush_replication_wait_seconds', None,
+                      'Seconds spent waiting for replication'),
+    'seconds': ('ampush_phase_seconds', None,
+                'Wall clock seconds spent in each phase'),
+}
+
+
+@contextmanager
+def phase(name=None, map_name=None):
+    '''
+Attribute counts made by this thread to phase name (and map_name, if
+given) until the with block ends, and time the block.
+    '''
+    saved = (getattr(_local, 'map_name', None),
+             getattr(_local, 'phase', None))
+    if map_name is not None:
+        _local.map_name = map_name
+    _local.phase = name
+    start = time.time()
+    try:
+        yield
+    finally:
+        count('seconds', time.time() - start)
+        _local.map_name, _local.phase = saved
+
+
+def count(metric=None, n=1):
+    ''' Add n to metric for this thread's current map and phase. '''
+    where = (getattr(_local, 'map_name', None) or '',
+             getattr(_local, 'phase', None) or 'other')
+    with _lock:
+        metrics = _counts.setdefault(where, {})
+        metrics[metric] = metrics.get(metric, 0) + n
+    return
+
+
+def totals():
+    ''' Return {metric: value} summed over all maps and phases. '''
+    out = {}
+    with _lock:
+        for metrics in _counts.values():
+            for metric, n in metrics.items():
+                out[metric] = out.get(metric, 0) + n
+    return out
+
+
+def reset():
+    ''' Start counting afresh, e.g. for ampush --watch's next pass. '''
+    global _started
+    with _lock:
+        _counts.clear()
+        _started = time.time()
+    return
+
+
+def write(name=None):
+    '''
+Write this run's numbers out, named for the mode unless name is given.
+Failure is logged, not fatal.
+    '''
+    from amlib import utils  # utils counts with us; import it late
+
+    mode = name or conf.c['mode'] or 'default'
+    with _lock:
+        rows = [{'map': k[0], 'phase': k[1], 'metrics': dict(v)}
+                for k, v in sorted(_counts.items())]
+    run = {'mode': mode,
+           'container': conf.c['am_container'],
+           'started': _started,
+           'seconds': time.time() - _started,
+           'totals': totals(),
+           'maps': rows}
+    utils.write_json(utils.state_path('metrics'), run)
+
+    if conf.c['metrics_textfile_dir']:
+        pathname = '{0}/ampush-{1}.prom'.format(
+            conf.c['metrics_textfile_dir'], mode)
+        _write_textfile(pathname=pathname, run=run)
+    return
+
+
+def _write_textfile(pathname=None, run=None):
+    ''' node_exporter reads whole files only, so write and rename. '''
+    lines = []
+    mode_label = 'mode="{0}"'.format(_escape(run['mode']))
+    lines.append('# HELP ampush_last_run_timestamp_seconds '
+                 'When the last run started')
+    lines.append('# TYPE ampush_last_run_timestamp_seconds gauge')
+    lines.append('ampush_last_run_timestamp_seconds{{{0}}} {1}'.format(
+        mode_label, run['started']))
+    lines.append('# HELP ampush_last_run_duration_seconds '
+                 'How long the last run took')
+    lines.append('# TYPE ampush_last_run_duration_seconds gauge')
+    lines.append('ampush_last_run_duration_seconds{{{0}}} {1}'.format(
+        mode_label, run['seconds']))
+
+    described = set()
+    for metric in sorted(PROM, key=lambda m: PROM[m][0]):
+        name, extra, help_text = PROM[metric]
+        if name not in described:
+            described.add(name)
+            help_text = help_text or PROM['search'][2]
+            lines.append('# HELP {0} {1}'.format(name, help_text))
+            lines.append('# TYPE {0} gauge'.format(name))
+        for row in run['maps']:
+            if metric not in row['metrics']:
+                continue
+            labels = [mode_label,
+                      'map="{0}"'.format(_escape(row['map'])),
+                      'phase="{0}"'.format(_escape(row['phase']))]
+            if extra is not None:
+                labels.append(extra)
+            lines.append('{0}{{{1}}} {2}'.format(name, ','.join(labels),
+                                                 row['metrics'][metric]))
+
+    tmp = pathname + '.tmp'
+    try:
+        f = open(tmp, 'w')
+        f.write('\n'.join(lines) + '\n')
+        f.close()
+        os.rename(tmp, pathname)
+    except (IOError, OSError) as e:
+        log_msg = 'Unable to write metrics file {0}: {1}'.format(pathname, e)
+        log.m.warning(log_msg)
+    return
+
+
+def _escape(in_str):
+    return in_str.replace('\\', '\\\\').replace('"', '\\"') \
+        .replace('\n', '\\n')
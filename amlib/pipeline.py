@@ -0,0 +1,130 @@
+import collections
+import ldap
+from amlib import log, metrics
+
+'''
+Asynchronous LDAP operations for ad_op.
+Part of ampush. https://github.com/sfu-rcg/ampush
+Copyright (C) 2016-2017 Research Computing Group, Simon Fraser University.
+'''
+
+
+'''
+Expected now and then, e.g. when a previous run died halfway or another
+DC beat us to it. Worth a warning, not a failure.
+'''
+WARN_ONLY = {'add': (ldap.ALREADY_EXISTS,
+                     'WARNING: Domain controller says {0} already exists'),
+             'delete': (ldap.NO_SUCH_OBJECT,
+                        'WARNING: Domain controller says {0} does not exist')}
+
+# the connection was lost; nothing outstanding on it will ever come back
+LOST = (ldap.SERVER_DOWN, ldap.TIMEOUT)
+
+
+class Pipeline(object):
+    '''
+Keep up to window add/modify/delete operations outstanding on one
+python-ldap connection, instead of waiting a full round trip for each.
+
+Results are collected oldest first. A failed operation is logged and
+recorded in self.failures; it doesn't hold up the ones behind it.
+on_done(op, dn, args) is called for every operation that succeeded.
+
+AD may run the outstanding operations on one connection in any order, so
+an operation waits for earlier ones on the same DN, its parents or its
+children before it's sent.
+
+If the connection is lost while operations are outstanding, they're sent
+again, in order, on the new one. Each is sent at most retries + 1 times.
+A re-sent add or delete that had in fact gone through comes back as
+ALREADY_EXISTS or NO_SUCH_OBJECT, which is only a warning.
+    '''
+
+    def __init__(self, conn=None, window=32, on_done=None, retries=3):
+        self.conn = conn
+        self.window = window
+        self.on_done = on_done
+        self.retries = retries
+        self.pending = collections.deque()  # (msgid, op, dn, args, tries)
+        self.failures = []                  # (op, dn, LDAPError)
+        self.submitted = 0
+
+    def submit(self, op=None, dn=None, args=None):
+        self._settle(dn)
+        while len(self.pending) >= self.window:
+            self._reap()
+        self._send(op, dn, args)
+        self.submitted += 1
+        return
+
+    def _send(self, op=None, dn=None, args=None, tries=1):
+        if op == 'add':
+            msgid = self.conn.add_ext(dn, args)
+        elif op == 'modify':
+            msgid = self.conn.modify_ext(dn, args)
+        elif op == 'delete':
+            msgid = self.conn.delete_ext(dn)
+        else:
+            raise Exception('Pipeline: unknown operation ' + str(op))
+        self.pending.append((msgid, op, dn, args, tries))
+        return
+
+    def search(self, base=None, scope=ldap.SCOPE_SUBTREE,
+               filterstr='(objectClass=*)', attrs=None):
+        ''' Synchronous search that sees every write submitted before it. '''
+        self._settle(base)
+        return self.conn.search_ext_s(base, scope, filterstr, attrs)
+
+    def drain(self):
+        ''' Wait for every outstanding operation. '''
+        while self.pending:
+            self._reap()
+        return
+
+    def _settle(self, dn):
+        dn = dn.lower()
+        while [p for p in self.pending if _related(dn, p[2].lower())]:
+            self._reap()
+        return
+
+    def _reap(self):
+        msgid, op, dn, args, tries = self.pending.popleft()
+        try:
+            self.conn.result3(msgid)
+        except LOST as e:
+            self._resend([(msgid, op, dn, args, tries)], e)
+            return
+        except ldap.LDAPError as e:
+            if op in WARN_ONLY and isinstance(e, WARN_ONLY[op][0]):
+                log.m.warning(WARN_ONLY[op][1].format(dn))
+            else:
+                log_msg = 'ad_{0} {1} failed: {2}'.format(op, dn, e)
+                log.m.error(log_msg)
+                self.failures.append((op, dn, e))
+                metrics.count('write_errors')
+            return
+
+        if self.on_done is not None:
+            self.on_done(op, dn, args)
+        return
+
+    def _resend(self, lost=None, e=None):
+        lost.extend(self.pending)
+        self.pending.clear()
+        log_msg = 'Connection lost ({0}); re-sending {1} operation(s)'
+        log.m.warning(log_msg.format(e.__class__.__name__, len(lost)))
+        for msgid, op, dn, args, tries in lost:
+            if tries > self.retries:
+                log_msg = 'ad_{0} {1} failed: {2}'.format(op, dn, e)
+                log.m.error(log_msg)
+                self.failures.append((op, dn, e))
+                metrics.count('write_errors')
+                continue
+            self._send(op, dn, args, tries + 1)
+        return
+
+
+def _related(a, b):
+    ''' Is one of two lowercased DNs the same as, or under, the other? '''
+    return a == b or a.endswith(',' + b) or b.endswith(',' + a)
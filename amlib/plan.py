@@ -0,0 +1,156 @@
+import os
+import json
+import time
+from amlib import utils, log
+
+'''
+Work out what it takes to make an AD map match a flat file map, without
+touching AD. sync.apply_plan() does the writing.
+
+Also reads and writes plan files for ampush --plan and --apply.
+Part of ampush. https://github.com/sfu-rcg/ampush
+Copyright (C) 2016-2017 Research Computing Group, Simon Fraser University.
+'''
+
+
+class Plan(object):
+    '''
+The changes one map needs:
+
+  deletes:  keys in AD but not in the flat file map
+  adds:     (key, entry) in the flat file map but not in AD
+  modifies: (key, flat file entry, AD entry) whose values differ
+
+Each list is sorted by key, so the same maps always give the same plan.
+    '''
+
+    def __init__(self, map_name=None, deletes=None, adds=None,
+                 modifies=None):
+        self.map_name = map_name
+        self.deletes = deletes or []
+        self.adds = adds or []
+        self.modifies = modifies or []
+
+    def __len__(self):
+        return len(self.deletes) + len(self.adds) + len(self.modifies)
+
+    def summary(self):
+        s = '{0}: {1} to add, {2} to delete, {3} to modify'
+        return s.format(self.map_name, len(self.adds), len(self.deletes),
+                        len(self.modifies))
+
+
+def in_sync(ff_v=None, ad_v=None):
+    '''
+Does an AD entry hold every value of a flat file entry? Only the flat
+file entry's fields count, so hook.munge may return plain dicts that
+leave some out.
+    '''
+    for attr, x in ff_v.items():
+        if ad_v.get(attr) != x:
+            return False
+    return True
+
+
+def diff(map_name=None, ff_map=None, ad_map=None):
+    '''
+Return a Plan turning ad_map into ff_map. Both are parsed maps, {key:
+entry}. ad_map is None if the map isn't in AD yet (dry run), in which case
+every entry is an add.
+    '''
+    if ad_map is None:
+        ad_map = {}
+    ff_keys = set(ff_map)
+    ad_keys = set(ad_map)
+
+    deletes = sorted(ad_keys - ff_keys)
+    adds = [(k, ff_map[k]) for k in sorted(ff_keys - ad_keys)]
+    modifies = [(k, ff_map[k], ad_map[k]) for k in sorted(ff_keys & ad_keys)
+                if not in_sync(ff_v=ff_map[k], ad_v=ad_map[k])]
+    return Plan(map_name=map_name, deletes=deletes, adds=adds,
+                modifies=modifies)
+
+
+'''
+A plan file lists the writes ad_op recorded for each mode, in order:
+
+{"version": 1, "created": "...",
+ "modes": [{"mode": null, "container": "CN=automounts,...",
+            "ops": [{"op": "add", "dn": "...", "args": [...],
+                     "expect": null}, ...]}, ...]}
+
+With several modes, each mode's process writes pathname.<mode> and
+merge() puts them together.
+'''
+FILE_VERSION = 1
+
+
+def part_path(pathname=None, mode=None):
+    return '{0}.{1}'.format(pathname, mode or 'default')
+
+
+def save_part(pathname=None, mode=None, container=None, ops=None):
+    _dump(pathname=part_path(pathname, mode),
+          data={'mode': mode, 'container': container, 'ops': ops})
+    return
+
+
+def merge(pathname=None, modes=None):
+    ''' Combine each mode's part file into pathname. Return the op count. '''
+    parts = []
+    for mode in modes:
+        parts.append(_load(part_path(pathname, mode)))
+        os.remove(part_path(pathname, mode))
+    _dump(pathname=pathname,
+          data={'version': FILE_VERSION,
+                'created': time.strftime('%Y-%m-%d %H:%M:%S %Z'),
+                'modes': parts})
+    return sum([len(part['ops']) for part in parts])
+
+
+def remove_parts(pathname=None, modes=None):
+    ''' Remove whatever part files are left for pathname. '''
+    if pathname is None:
+        return
+    for mode in modes:
+        if utils.file_exists(part_path(pathname, mode)):
+            os.remove(part_path(pathname, mode))
+    return
+
+
+def load(pathname=None):
+    ''' Return the modes in a plan file, with ops ready for ad_op.replay(). '''
+    data = _load(pathname)
+    if data.get('version') != FILE_VERSION:
+        _bad_file(pathname, 'unsupported version ' + str(data.get('version')))
+    for part in data['modes']:
+        for op in part['ops']:
+            # JSON has no tuples; python-ldap wants its modlists in them
+            op['args'] = [tuple(x) for x in op['args'] or []] or None
+    return data['modes']
+
+
+def _load(pathname=None):
+    data = utils.read_json(pathname)
+    if data is None:
+        _bad_file(pathname, 'unreadable or not JSON')
+    return data
+
+
+def _dump(pathname=None, data=None):
+    tmp = pathname + '.tmp'
+    try:
+        f = open(tmp, 'w')
+        json.dump(data, f, indent=1, sort_keys=True)
+        f.close()
+        os.rename(tmp, pathname)
+    except (IOError, OSError) as e:
+        _bad_file(pathname, str(e))
+    return
+
+
+def _bad_file(pathname=None, why=None):
+    log_msg = 'Terminating. Plan file {0}: {1}'.format(pathname, why)
+    log.m.critical(log_msg)
+    print(log_msg)
+    exit(22)
@@ -0,0 +1,199 @@
+import os
+import gc
+import sys
+import time
+import pstats
+import cProfile
+import threading
+from contextlib import contextmanager
+from amlib import conf, log
+
+try:
+    import tracemalloc  # python 3.4+
+except ImportError:
+    tracemalloc = None
+
+'''
+ampush --profile DIR: profile each map's sync separately. For every map,
+DIR gets
+
+  <mode>.<pass>.<map>.pstats     cProfile data; python -m pstats to browse
+  <mode>.<pass>.<map>.alloc.txt  where memory was allocated while syncing it
+
+and summary-<mode>.txt ranks the maps by time taken. <pass> is sync, or
+resync for a map synced again after conflict objects turned up in it.
+
+cProfile follows only the thread it was started in, so each map's profile
+is its own even with --jobs. Memory is measured for the whole process, so
+with --jobs > 1 a map's allocation report includes its neighbours'.
+
+Without tracemalloc (Python 2), the report is the net growth in objects
+the garbage collector tracks, by type, with their sys.getsizeof() sizes.
+That covers dicts, lists, tuples and instances (our MapEntry records,
+say) but not the strings and numbers inside them, and walking every
+object before and after each map makes profiled runs slower still.
+
+Part of ampush. https://github.com/sfu-rcg/ampush
+Copyright (C) 2016-2017 Research Computing Group, Simon Fraser University.
+'''
+ALLOC_FRAMES = 10   # stack depth tracemalloc records
+ALLOC_TOP = 25      # lines in each allocation report
+
+_dir = None
+_lock = threading.Lock()
+_summary = []       # one dict per profiled map and pass
+_pass = 'sync'      # see named_pass()
+
+
+def start(pathname=None):
+    ''' Turn profiling on, writing to directory pathname. '''
+    global _dir
+    try:
+        if not os.path.isdir(pathname):
+            os.makedirs(pathname)
+    except OSError as e:
+        log_msg = 'Terminating. Unable to create profile directory ' + \
+                  '{0}: {1}'.format(pathname, e)
+        log.m.critical(log_msg)
+        print(log_msg)
+        exit(23)
+    _dir = pathname
+    if tracemalloc is not None:
+        tracemalloc.start(ALLOC_FRAMES)
+    return
+
+
+@contextmanager
+def named_pass(name=None):
+    ''' Label the maps profiled in the with block as being pass name's. '''
+    global _pass
+    saved = _pass
+    _pass = name
+    try:
+        yield
+    finally:
+        _pass = saved
+
+
+@contextmanager
+def map_profile(map_name=None):
+    ''' Profile the with block as the sync of map_name. '''
+    if _dir is None:
+        yield
+        return
+
+    pass_name = _pass
+    prefix = '{0}/{1}.{2}.{3}'.format(_dir, conf.c['mode'] or 'default',
+                                      pass_name, map_name.replace('/', '_'))
+    prof = cProfile.Profile()
+    before = _memory()
+    start = time.time()
+    try:
+        prof.enable()
+    except ValueError as e:  # another profiler has this thread
+        log.m.warning('Not profiling {0}: {1}'.format(map_name, e))
+        prof = None
+    try:
+        yield
+    finally:
+        if prof is not None:
+            prof.disable()
+        wall = time.time() - start
+        _finish(map_name=map_name, prefix=prefix, prof=prof, wall=wall,
+                before=before, pass_name=pass_name)
+
+
+def _memory():
+    if tracemalloc is not None:
+        return tracemalloc.take_snapshot()
+    return _gc_types()
+
+
+def _gc_types():
+    ''' Return {type name: [count, bytes]} for every gc-tracked object. '''
+    types = {}
+    for obj in gc.get_objects():
+        t = types.setdefault(type(obj).__name__, [0, 0])
+        t[0] += 1
+        t[1] += sys.getsizeof(obj, 0)
+    return types
+
+
+def _finish(map_name=None, prefix=None, prof=None, wall=None, before=None,
+            pass_name=None):
+    row = {'map': map_name, 'pass': pass_name, 'wall': wall, 'top_s': 0.0,
+           'top': '-', 'alloc_kb': 0.0}
+    if prof is not None:
+        prof.dump_stats(prefix + '.pstats')
+        stats = pstats.Stats(prof)
+        worst = sorted(stats.stats.items(), key=lambda x: x[1][2])
+        if worst:
+            (filename, line, func), s = worst[-1]
+            row['top_s'] = s[2]  # tottime
+            row['top'] = '{0}:{1}({2})'.format(os.path.basename(filename),
+                                               line, func)
+
+    lines = []
+    if tracemalloc is not None:
+        diff = tracemalloc.take_snapshot().compare_to(before, 'lineno')
+        row['alloc_kb'] = sum([d.size_diff for d in diff]) / 1024.0
+        lines.append('Net allocations while syncing {0}: {1:.1f} KB'.format(
+            map_name, row['alloc_kb']))
+        lines.extend([str(d) for d in diff[:ALLOC_TOP]])
+    else:
+        after = _gc_types()
+        diff = []
+        for name, (n, size) in after.items():
+            was = before.get(name, [0, 0])
+            if n != was[0] or size != was[1]:
+                diff.append((size - was[1], n - was[0], name))
+        for name, (n, size) in before.items():
+            if name not in after:
+                diff.append((-size, -n, name))
+        diff.sort(reverse=True)
+        row['alloc_kb'] = sum([d[0] for d in diff]) / 1024.0
+        lines.append('Net growth in gc-tracked objects while syncing ' +
+                     '{0}: {1:.1f} KB'.format(map_name, row['alloc_kb']))
+        lines.extend(['{0:>+12} B {1:>+9} {2}'.format(*d)
+                      for d in diff[:ALLOC_TOP]])
+    try:
+        f = open(prefix + '.alloc.txt', 'w')
+        f.write('\n'.join(lines) + '\n')
+        f.close()
+    except IOError as e:
+        log.m.warning('Unable to write {0}.alloc.txt: {1}'.format(prefix, e))
+
+    with _lock:
+        _summary.append(row)
+    return
+
+
+def reset():
+    ''' Forget the maps profiled so far, e.g. after a --watch pass. '''
+    with _lock:
+        del _summary[:]
+    return
+
+
+def write_summary():
+    ''' Rank this mode's maps by wall clock time, slowest first. '''
+    if _dir is None:
+        return
+    with _lock:
+        rows = sorted(_summary, key=lambda r: r['wall'], reverse=True)
+    pathname = '{0}/summary-{1}.txt'.format(_dir, conf.c['mode'] or 'default')
+    lines = ['{0:<30} {1:<6} {2:>9} {3:>9} {4:>11}  {5}'.format(
+        'map', 'pass', 'wall s', 'alloc KB', 'top s', 'most time in')]
+    for r in rows:
+        lines.append('{0:<30} {1:<6} {2:9.3f} {3:9.1f} {4:11.3f}  {5}'.format(
+            r['map'], r['pass'], r['wall'], r['alloc_kb'], r['top_s'],
+            r['top']))
+    try:
+        f = open(pathname, 'w')
+        f.write('\n'.join(lines) + '\n')
+        f.close()
+    except IOError as e:
+        log.m.warning('Unable to write {0}: {1}'.format(pathname, e))
+        return
+    log.m.info('Wrote profiles of {0} maps to {1}'.format(len(rows), _dir))
+    return
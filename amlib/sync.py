@@ -1,5 +1,8 @@
 import re
-from amlib import conf, log, ad_op, utils, cnx, hook, argp
+from multiprocessing import Process
+from multiprocessing.pool import ThreadPool
+from amlib import conf, log, ad_op, utils, cnx, hook, plan, metrics
+from amlib import profiling
 from amlib import file_map as fm
 from amlib import ad_map as adm
 import ldap.modlist as modlist
@@ -16,16 +19,22 @@ Copyright (C) 2016-2017 Research Computing Group, Simon Fraser University.
 
 
 def preflight():
-    ad_op.verify_am_container_exists()
+    ''' Flat file checks. Each mode checks its own AD container. '''
     utils.verify_ff_am_dir_exists()
     utils.verify_ff_master_exists()
     fm.detect_orphans()
     return
 
 
-def do(maps=None, dry_run=True):
-    ''' Let's DO THIS THING '''
-    preflight()
+def do(maps=None, dry_run=True, full=False, jobs=1, plan_path=None):
+    '''
+Let's DO THIS THING. With plan_path, nothing is written to AD; the writes
+that would have been made are saved to plan_path for apply_file().
+    '''
+    if plan_path is not None:
+        dry_run = True
+    with metrics.phase('preflight'):
+        preflight()
 
     # argparse shoves "None" in the list which is not super helpful.
     # filter it out
@@ -34,24 +43,222 @@ def do(maps=None, dry_run=True):
     else:
         maps = []
 
+    # parse the flat files once, however many containers we push to
+    parse_ff_maps(map_names=maps or fm.get_names())
+    if conf.c['check_hostnames'] != '0':
+        with metrics.phase('dns'):
+            check_hostnames(map_names=maps or fm.get_names())
+
+    modes = conf.c['modes']
+    try:
+        if len(modes) == 1:
+            do_mode(mode=modes[0], maps=maps, dry_run=dry_run, full=full,
+                    jobs=jobs, plan_path=plan_path)
+        else:
+            do_modes(modes=modes, maps=maps, dry_run=dry_run, full=full,
+                     jobs=jobs, plan_path=plan_path)
+        save_plan(plan_path=plan_path, modes=modes)
+    finally:  # a mode that failed may have left its part behind
+        plan.remove_parts(pathname=plan_path, modes=modes)
+    return
+
+
+def do_modes(modes=None, maps=None, dry_run=True, full=False, jobs=1,
+             plan_path=None):
+    '''
+One process per mode. Each has its own conf.c['am_container'], Kerberos
+credentials, AD connections and snapshot, and inherits the parsed flat
+file maps from us. A mode killed by a signal fails the run with exit
+code 24.
+    '''
+    cnx.pin()
+    procs = []
+    for mode in modes:
+        proc = Process(target=do_mode,
+                       kwargs={'mode': mode, 'maps': maps,
+                               'dry_run': dry_run, 'full': full,
+                               'jobs': jobs, 'plan_path': plan_path})
+        proc.start()
+        procs.append((mode, proc))
+
+    failed = 0
+    for mode, proc in procs:
+        proc.join()
+        if proc.exitcode < 0:
+            log_msg = 'Push to mode {0} was killed by signal {1}'
+            log.m.critical(log_msg.format(mode, -proc.exitcode))
+            failed = 24
+        elif proc.exitcode != 0:
+            log_msg = 'Push to mode {0} failed with exit code {1}'
+            log.m.critical(log_msg.format(mode, proc.exitcode))
+            failed = proc.exitcode
+    if failed != 0:
+        exit(failed)
+    return
+
+
+def save_plan(plan_path=None, modes=None):
+    if plan_path is None:
+        return
+    count = plan.merge(pathname=plan_path, modes=modes)
+    log.m.info('Wrote {0} AD operations to {1}'.format(count, plan_path))
+    return
+
+
+def do_mode(mode=None, maps=None, dry_run=True, full=False, jobs=1,
+            plan_path=None):
+    ''' Push the flat file maps to the AD container for one mode. '''
+    conf.use_mode(mode)
+    if len(conf.c['modes']) > 1:
+        log.tag('[{0}]'.format(mode or 'default'))
+    with metrics.phase('ad_read'):
+        ad_op.verify_am_container_exists()
+    if plan_path is not None:
+        ad_op.record_begin()
+
+    # compare maps that had conflicts, even if they look unchanged
+    with metrics.phase('conflicts'):
+        for map_name in ad_op.conflict_sweep():
+            forget(map_name=map_name)
+
     if len(maps) == 0:
         log.m.debug('Default action: sync all maps')
-        all_parent_maps(dry_run=dry_run)
-        all_map_contents(dry_run=dry_run)
+        with metrics.phase('parent_maps'):
+            all_parent_maps(dry_run=dry_run)
+        all_map_contents(dry_run=dry_run, full=full, jobs=jobs)
     else:  # >=1 maps passed to --sync
         log_msg = 'Syncing maps passed as args: ' + ' '.join(maps)
         log.m.debug(log_msg)
-        for map_name in maps:
-            parent_map(map_name=map_name, dry_run=dry_run)
-            conflicts_found = None
-            conflicts_found = map_contents(map_name=map_name,
-                                           dry_run=dry_run)
-            if conflicts_found is True:
-                log.m.info('Resyncing ' + map_name)
-                map_contents(map_name=map_name, dry_run=dry_run)
+        with metrics.phase('parent_maps'):
+            ad_op.batch_begin()
+            for map_name in maps:
+                parent_map(map_name=map_name, dry_run=dry_run)
+            ad_op.batch_end()
+        # maps named on the command line are always compared
+        sync_contents(map_names=maps, dry_run=dry_run, full=True, jobs=jobs)
+    resync_conflicts(map_names=maps or fm.get_names(), dry_run=dry_run,
+                     jobs=jobs)
+
+    if dry_run is False:
+        with metrics.phase('manifest'):
+            save_manifest()
+    if plan_path is not None:
+        plan.save_part(pathname=plan_path, mode=mode,
+                       container=conf.c['am_container'],
+                       ops=ad_op.recorded())
+
+    cnx.log_stats()
+    metrics.write()
+    profiling.write_summary()
+    check_failures()
+    return
+
+
+def watch_pass(map_names=None, dry_run=True, jobs=1):
+    '''
+One ampush --watch pass: sync the maps in map_names (None: all of them)
+to each mode's container. Unlike do(), modes are pushed one after another
+in this process, so that AD connections and credentials stay warm from
+one pass to the next. Metrics and profiles are written per mode and pass.
+    '''
+    global _manifest
+    ff_map_names = fm.get_names()
+    if map_names is None:
+        changed, full = ff_map_names, False
+        gone = True
+    else:  # named maps were edited, so always compare them
+        changed, full = [m for m in ff_map_names if m in map_names], True
+        gone = len([m for m in map_names if m.startswith('auto.') and
+                    m not in ff_map_names]) > 0
+    if len(changed) == 0 and gone is False:
+        return
+    log.m.info('Syncing ' + (' '.join(changed) or 'deleted maps'))
+    metrics.reset()  # anything left by a pass that stopped part way
+    profiling.reset()
+
+    parse_ff_maps(map_names=changed)
+    if conf.c['check_hostnames'] != '0':
+        with metrics.phase('dns'):
+            check_hostnames(map_names=changed)
+
+    failures = ad_op.failure_count()
+    for mode in conf.c['modes']:
+        conf.use_mode(mode)
+        if len(conf.c['modes']) > 1:
+            log.tag('[{0}]'.format(mode or 'default'))
+        _manifest = None  # each container has its own
+        with metrics.phase('ad_read'):
+            ad_op.verify_am_container_exists()  # picks up others' changes
+        with metrics.phase('conflicts'):
+            for map_name in ad_op.conflict_sweep():
+                forget(map_name=map_name)
+
+        with metrics.phase('parent_maps'):
+            ad_op.batch_begin()
+            for map_name in changed:
+                parent_map(map_name=map_name, dry_run=dry_run)
+            if gone is True:
+                ad_op.batch_flush()
+                clean_ad(dry_run=dry_run)
+            ad_op.batch_end()
+        sync_contents(map_names=changed, dry_run=dry_run, full=full,
+                      jobs=jobs)
+        resync_conflicts(map_names=changed, dry_run=dry_run, jobs=jobs)
+        if dry_run is False:
+            with metrics.phase('manifest'):
+                save_manifest()
+        metrics.write()
+        profiling.write_summary()
+        metrics.reset()
+        profiling.reset()
+
+    cnx.log_stats()
+    if ad_op.failure_count() > failures:
+        log_msg = '{0} writes were refused by AD; see above.'
+        log.m.error(log_msg.format(ad_op.failure_count() - failures))
     return
 
 
+def check_failures():
+    if ad_op.failure_count() > 0:
+        log_msg = 'Terminating. {0} writes were refused by AD; see above.'
+        log_msg = log_msg.format(ad_op.failure_count())
+        log.m.critical(log_msg)
+        print(log_msg)
+        exit(20)
+    return
+
+
+def parse_ff_maps(map_names=None):
+    ''' Parse the flat file maps into file_map's cache, up front. '''
+    for map_name in map_names:
+        with metrics.phase('ff_parse', map_name=map_name):
+            fm.parse(map_name)
+    return
+
+
+def check_hostnames(map_names=None):
+    ''' Check the NFS servers of the maps all resolve, each only once. '''
+    hosts = {}
+    for map_name in map_names:
+        if map_name == conf.c['master_map_name']:
+            continue
+        for v in fm.parse(map_name).values():
+            used_in = hosts.setdefault(v['server_hostname'], [])
+            if map_name not in used_in:
+                used_in.append(map_name)
+    utils.check_hostnames(hosts=hosts)
+    return
+
+
+def ff_map_copy(map_name=None):
+    '''
+Return a private copy of a parsed flat file map for hook.munge. Entries
+hold only strings, so copying each entry is as good as a deepcopy.
+    '''
+    return dict((k, v.copy()) for k, v in fm.parse(map_name).items())
+
+
 def all_parent_maps(dry_run=True):
     '''
     Sync just the parent map objects themselves. Do NOT touch their
@@ -60,26 +267,131 @@ in AD that have no flat file equivalent.
     '''
     # Map exists in flatfile but not AD? create it in AD
     # Map exists in AD but not in flatfile? delete it from AD
+    ad_op.batch_begin()
     for ff_map_name in fm.get_names():
         parent_map(map_name=ff_map_name, dry_run=dry_run)
+    ad_op.batch_flush()  # clean_ad() needs to see the new maps
     clean_ad(dry_run=dry_run)
+    ad_op.batch_end()
     return
 
 
-def all_map_contents(dry_run=True):
-    for ff_map_name in fm.get_names():
-        conflicts_found = None
-        conflicts_found = map_contents(map_name=ff_map_name, dry_run=dry_run)
-        if conflicts_found is True:
-            log.m.info('Resyncing ' + ff_map_name)
-            map_contents(map_name=ff_map_name, dry_run=dry_run)
+def all_map_contents(dry_run=True, full=False, jobs=1):
+    sync_contents(map_names=fm.get_names(), dry_run=dry_run, full=full,
+                  jobs=jobs)
+    return
+
+
+def sync_contents(map_names=None, dry_run=True, full=False, jobs=1):
+    '''
+Sync the contents of several maps. The master and direct maps go first,
+in order. The remaining maps don't depend on each other and are shared out
+between up to jobs worker threads, each with its own AD connection.
+    '''
+    first = [conf.c['master_map_name'], conf.c['direct_map_name']]
+    rest = []
+    for map_name in map_names:
+        if map_name in first:
+            map_contents(map_name=map_name, dry_run=dry_run, full=full)
+        else:
+            rest.append(map_name)
+
+    if jobs <= 1 or len(rest) <= 1:
+        for map_name in rest:
+            map_contents(map_name=map_name, dry_run=dry_run, full=full)
+        return
+
+    log.m.debug('Syncing {0} maps with {1} jobs'.format(len(rest), jobs))
+    pool = ThreadPool(min(jobs, len(rest)))
+    work = [(map_name, dry_run, full) for map_name in rest]
+    for failure in pool.imap_unordered(_map_contents_job, work):
+        if failure is not None:  # a worker hit exit(); so do we
+            pool.terminate()
+            raise failure
+    pool.close()
+    pool.join()
+    return
+
+
+def _map_contents_job(args):
+    '''
+Worker thread body. Keep this map's log lines together, and hand exit()
+back to the main thread rather than letting it kill the worker.
+    '''
+    map_name, dry_run, full = args
+    log.hold()
+    try:
+        try:
+            map_contents(map_name=map_name, dry_run=dry_run, full=full)
+        finally:
+            ad_op.release()  # its last flush can fail, or exit, too
+    except SystemExit as e:
+        return e
+    finally:
+        log.release()
+    return None
+
+
+def resync_conflicts(map_names=None, dry_run=True, jobs=1):
+    '''
+Our writes can collide with another DC's and come back as conflict
+objects once replication catches up. Sweep for them, and sync the maps
+they turned up in once more. If nothing was written, there's nothing
+new to find.
+    '''
+    if ad_op.write_count() == 0:
+        return
+    with metrics.phase('conflicts'):
+        conflicted = ad_op.conflict_sweep()
+    resync = [m for m in map_names if m.lower() in conflicted]
+    if len(resync) > 0:
+        log.m.info('Resyncing ' + ' '.join(resync))
+        with profiling.named_pass('resync'):
+            sync_contents(map_names=resync, dry_run=dry_run, full=True,
+                          jobs=jobs)
+    return
+
+
+'''
+Manifest: for each map, [content hash of the flat file map taken after
+hook.munge, ad_map.fingerprint() of the map in AD], as of the last time
+the two were known to agree. A map is skipped, unless --full is given,
+only if both still match: an edit in AD by hand changes the fingerprint
+however many times AD has been read since.
+'''
+_manifest = None
+
+
+def manifest():
+    global _manifest
+    if _manifest is None:
+        _manifest = utils.read_json(utils.state_path('manifest')) or {}
+    return _manifest
+
+
+def save_manifest():
+    # forget maps that no longer exist on the filesystem
+    ff_map_names = fm.get_names()
+    for map_name in list(manifest().keys()):
+        if map_name not in ff_map_names:
+            del manifest()[map_name]
+    utils.write_json(utils.state_path('manifest'), manifest())
+    return
+
+
+def forget(map_name=None):
+    ''' Drop a map from the manifest, so that it is compared next time. '''
+    for k in list(manifest().keys()):
+        if k.lower() == map_name.lower():
+            del manifest()[k]
     return
 
 
 def clean_ad(dry_run=True):
     ''' Map exists in AD but not on the filesystem? Delete it from AD. '''
+    ff_map_names = set(fm.get_names())
     for ad_map_name in adm.get_names():
-        if ad_map_name not in fm.get_names():
+        if ad_map_name not in ff_map_names:
             ad_map_cn = utils.map_cn(ad_map_name)
             log_msg = ad_map_name + ' exists in AD but not on filesystem'
             log.m.info(log_msg)
@@ -92,8 +404,7 @@ def parent_map(map_name=None, dry_run=True):
  https://www.ietf.org/rfc/rfc2307.txt '''
     # log.m.debug('sync.parent_map:' + map_name)
 
-    ad_map_cn = utils.map_cn(map_name)
-    if ad_op.get(ad_map_cn) is not None:
+    if adm.exists(map_name) is True:
         # log.m.debug('Parent map already exists: ' + map_name)
         return
 
@@ -118,88 +429,166 @@ def parent_map(map_name=None, dry_run=True):
     return
 
 
-def map_contents(map_name=None, dry_run=True):
-    '''
-Read a single flat file map from disk.
+def map_contents(map_name=None, dry_run=True, full=False):
+    ''' Sync one map's contents, under ampush --profile if it's on. '''
+    with profiling.map_profile(map_name=map_name):
+        _map_contents(map_name=map_name, dry_run=dry_run, full=full)
+    return
+
 
-Pass 1: Keys that exist in AD but not in flat file maps: delete from AD.
-Pass 2: Keys that exist in flat file maps but not in AD: create in AD.
-Pass 3: Keys that exist in both places but whose values differ:
-        delete from AD, create in AD with updated info.
+def _map_contents(map_name=None, dry_run=True, full=False):
+    '''
+Read a single flat file map from disk. Skip it if it matches the manifest,
+unless full is True. Otherwise compare it with AD (plan.diff) and make
+the changes (apply_plan):
+
+Keys that exist in AD but not in flat file maps: delete from AD.
+Keys that exist in flat file maps but not in AD: create in AD.
+Keys that exist in both places but whose values differ:
+    modify nisMapEntry in place with the updated info.
     '''
     # log.m.debug('sync.map_contents:' + map_name)
 
-    conflicts_found = None
-    if ad_op.conflict_catcher(map_name=map_name) is True:
-        conflicts_found = True
-
     # Read flat file map, then run modification hooks (if any)
     # before anything is pushed into Active Directory.
-    ff_map = fm.parse(map_name)
-    ff_map = hook.munge(map_name=map_name, map_meat=ff_map)
-
-    ad_map = adm.parse(map_name)
-
-    # Pass 1
-    if ad_map is not None:
-        for k in ad_map.keys():
-            if k not in ff_map:
-                target = 'cn={0},cn={1},{2}'
-                target = target.format(k, map_name, conf.c['am_container'])
-                ad_op.delete(cn=target, dry_run=dry_run)
-
-    # Pass 2
-    for k in ff_map.keys():
-        if ad_map is not None:
-            if k not in ad_map:
-                ad_op.create_map_entry(map_name=map_name,
-                                       entry_k=k,
-                                       entry_v=ff_map[k],
-                                       dry_run=dry_run)
+    with metrics.phase('diff', map_name=map_name):
+        ff_map = ff_map_copy(map_name)
+        ff_map = hook.munge(map_name=map_name, map_meat=ff_map)
+        ff_hash = utils.map_hash(ff_map)
+
+    with metrics.phase('ad_read', map_name=map_name):
+        ad_print = adm.fingerprint(map_name)
+    skip = full is False and ad_print is not None and \
+        manifest().get(map_name) == [ff_hash, ad_print]
+    if skip is True:
+        log.m.debug(map_name + ' unchanged since last push')
+        return None
+
+    with metrics.phase('ad_parse', map_name=map_name):
+        ad_map = adm.parse(map_name)
+    with metrics.phase('diff', map_name=map_name):
+        map_plan = plan.diff(map_name=map_name, ff_map=ff_map, ad_map=ad_map)
+    with metrics.phase('write', map_name=map_name):
+        apply_plan(map_plan=map_plan, dry_run=dry_run)
+
+    if dry_run is False:
+        if len(map_plan) > 0:  # our writes' USNs aren't known until next run
+            ad_print = None
+        manifest()[map_name] = [ff_hash, ad_print]
+    return
+
+
+def apply_plan(map_plan=None, dry_run=True):
+    ''' Make the changes in a plan.Plan, as one batch of writes. '''
+    if len(map_plan) == 0:
+        return
+    log.m.info(utils.dry_msg(in_str=map_plan.summary(), dry_run=dry_run))
+    map_name = map_plan.map_name
+
+    ad_op.batch_begin()
+    for k in map_plan.deletes:
+        target = 'cn={0},cn={1},{2}'
+        target = target.format(k, map_name, conf.c['am_container'])
+        ad_op.delete(cn=target, dry_run=dry_run)
+
+    for k, v in map_plan.adds:
+        ad_op.create_map_entry(map_name=map_name,
+                               entry_k=k,
+                               entry_v=v,
+                               dry_run=dry_run)
+
+    for k, v, ad_v in map_plan.modifies:
+        log_msg = 'AD:{1} - {0} is out of sync'.format(k, map_name)
+        log.m.info(log_msg)
+
+        log_msg = 'ad_current: ' + str(ad_v)
+        log.m.debug(log_msg)
+
+        ad_op.modify_map_entry(map_name=map_name,
+                               entry_k=k,
+                               entry_v=v,
+                               ad_entry_v=ad_v,
+                               dry_run=dry_run)
+    ad_op.batch_end()
+    return
+
+
+def apply_file(pathname=None):
+    '''
+Make the writes saved by ampush --plan. The flat files and the container
+aren't read; each object a write touches is checked first to be as it
+was when the plan was made. If any isn't, nothing is written.
+    '''
+    for part in plan.load(pathname):
+        conf.use_mode(part['mode'])
+        if conf.c['am_container'].lower() != part['container'].lower():
+            log_msg = 'Terminating. Plan was made for {0}, but mode {1} ' + \
+                      'is now {2}. Make a new plan.'
+            log_msg = log_msg.format(part['container'],
+                                     part['mode'] or 'default',
+                                     conf.c['am_container'])
+            log.m.critical(log_msg)
+            print(log_msg)
+            exit(21)
+
+        stale = stale_ops(ops=part['ops'])
+        if len(stale) > 0:
+            for op, why in stale:
+                log.m.error('Plan is stale: {0} {1}: {2}'.format(
+                    op['op'], op['dn'], why))
+            log_msg = 'Terminating. {0} objects changed in AD since the ' + \
+                      'plan was made. Nothing written. Make a new plan.'
+            log_msg = log_msg.format(len(stale))
+            log.m.critical(log_msg)
+            print(log_msg)
+            exit(21)
+
+        log_msg = 'Applying {0} AD operations to {1}'
+        log.m.info(log_msg.format(len(part['ops']), part['container']))
+        with metrics.phase('write'):
+            ad_op.batch_begin()
+            for op in part['ops']:
+                ad_op.replay(op=op['op'], dn=op['dn'], args=op['args'])
+            ad_op.batch_end()
+
+    cnx.log_stats()
+    metrics.write(name='apply')
+    check_failures()
+    return
+
+
+def stale_ops(ops=None):
+    '''
+Return (op, reason) for every op whose precondition doesn't hold in AD.
+Only the first op on each DN is checked; later ones depend on it.
+    '''
+    first, touched = [], set()
+    for op in ops:
+        if op['dn'].lower() not in touched:
+            first.append(op)
+            touched.add(op['dn'].lower())
+
+    attrs = set()
+    for op in first:
+        attrs.update((op['expect'] or {}).keys())
+    attrs = sorted(attrs) or ['1.1']  # 1.1: no attributes, thanks
+
+    found = {}
+    for dn, current in adm.read(dns=[op['dn'] for op in first], attrs=attrs):
+        found[dn.lower()] = current
+
+    stale = []
+    for op in first:
+        current = found[op['dn'].lower()]
+        if op['expect'] is None:
+            if current is not None:
+                stale.append((op, 'already exists'))
+        elif current is None:
+            stale.append((op, 'does not exist'))
         else:
-            pass
-            # log_msg = 'Null result from AD for {0}:{1}'.format(map_name, k)
-            # log.m.debug(log_msg)
-
-    # refresh our view of AD before proceeding
-    ad_map = adm.parse(map_name)
-
-    # Pass 3
-    for k in ff_map.keys():
-        if ad_map is None:
-            log_msg = "Skipping sync pass 3; AD:{0}=>{1} does not exist " + \
-                      "yet. You're probably in dry run mode. If you " + \
-                      "aren't, file a bug! I'm really sorry."
-            log_msg = log_msg.format(map_name, k)
-            log.m.info(log_msg)
-            continue
-        if k in ad_map:
-            in_sync = True
-
-            # common maps: iterate over server_dir, server_hostname & options
-            # master map: iterate over map, options
-            for attr, x in ff_map[k].items():
-                if ad_map[k][attr] != ff_map[k][attr]:
-                    in_sync = False
-
-            if in_sync is False:
-                target = 'cn={0},cn={1},{2}'
-                log_msg = 'AD:{1} - {0} is out of sync'.format(k, map_name)
-                log.m.info(log_msg)
-
-                log_msg = 'ad_current: ' + str(ad_map[k])
-                log.m.debug(log_msg)
-
-                target = target.format(utils.strip_slash(k),
-                                       map_name,
-                                       conf.c['am_container'])
-                ad_op.delete(cn=target, dry_run=dry_run)
-
-                ad_op.create_map_entry(map_name=map_name,
-                                       entry_k=k,
-                                       entry_v=ff_map[k],
-                                       dry_run=dry_run)
-    # one more time...
-    if ad_op.conflict_catcher(map_name=map_name) is True:
-        conflicts_found = True
-    return conflicts_found  # True == we should re-run the sync
+            for attr, v in op['expect'].items():
+                if current.get(attr) != v:
+                    stale.append((op, '{0} is now {1}'.format(
+                        attr, current.get(attr))))
+                    break
+    return stale
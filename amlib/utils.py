@@ -1,15 +1,22 @@
 import socket
-import ldap
 import os
 import re
+import json
+import hashlib
 
-import conf, cnx, log
+import conf, log, metrics
 
 '''
 Part of ampush. https://github.com/sfu-rcg/ampush
 Copyright (C) 2016-2017 Research Computing Group, Simon Fraser University.
 '''
 
+# compiled once; these run for every entry of every map
+_MOUNT_OPTIONS = re.compile(r'^-.*$')
+_SERVER_PATH = re.compile(r'.*:.*')
+_FQHN = re.compile(r'.*\..*')
+_SLASH = re.compile(r'^/')
+
 
 def wait_for_replication(seconds=10):
     # cheap way to avoid duplicates (CNF:* objects)
@@ -20,20 +27,105 @@ def wait_for_replication(seconds=10):
 
     log.m.debug('wait_for_replication: {0}s'.format(seconds))
     sleep(seconds)
+    metrics.count('sleep_seconds', seconds)
     return
 
 
-def check_hostname_resolves(hostname=None, map_name=None):
-    try:
-        socket.gethostbyname(hostname)
-    except socket.error:
-        log_msg = "Terminating. Can't resolve hostname {0} in {1}"
-        log_msg = log_msg.format(hostname, map_name)
+def check_hostnames(hosts=None):
+    '''
+Check that every NFS server hostname resolves. hosts is {hostname: [map
+name, ...]}. Lookups run ${ampush.conf/dns_jobs} at a time, and any not
+answered within ${ampush.conf/dns_timeout} seconds of starting count as
+failures.
+Hostnames that resolved within the last ${ampush.conf/dns_cache_ttl}
+seconds aren't looked up again. Every failure is reported before
+terminating.
+    '''
+    import time
+
+    pathname = '{0}/dns.json'.format(conf.c['state_dir'])
+    ttl = float(conf.c['dns_cache_ttl'])
+    now = time.time()
+    cache = read_json(pathname) or {}
+    cache = dict((k, v) for k, v in cache.items() if now - v < ttl)
+
+    todo = sorted([h for h in hosts if h not in cache])
+    log_msg = 'Resolving {0} hostnames ({1} cached)'
+    log.m.debug(log_msg.format(len(todo), len(hosts) - len(todo)))
+
+    failed = []
+    if len(todo) > 0:
+        found = _lookups(hostnames=todo, jobs=int(conf.c['dns_jobs']),
+                         timeout=float(conf.c['dns_timeout']))
+        for hostname in todo:
+            if found[hostname] is True:
+                cache[hostname] = now
+            else:
+                failed.append(hostname)
+        write_json(pathname, cache)
+
+    if len(failed) > 0:
+        for hostname in failed:
+            log_msg = "Can't resolve hostname {0} in {1}"
+            log_msg = log_msg.format(hostname, ' '.join(hosts[hostname]))
+            log.m.critical(log_msg)
+            print(log_msg)
+        log_msg = 'Terminating. {0} hostnames did not resolve'
+        log_msg = log_msg.format(len(failed))
         log.m.critical(log_msg)
+        print(log_msg)
         exit(3)
     return
 
 
+def _lookups(hostnames=None, jobs=1, timeout=None):
+    '''
+Resolve hostnames, up to jobs at a time, and return {hostname: True if it
+resolved}. Each lookup gets timeout seconds from when it starts. One that
+runs out is counted as failed and its slot goes to the next hostname; its
+thread is left to finish on its own, as a lookup can't be interrupted.
+    '''
+    import time
+    import threading
+    from Queue import Queue, Empty
+
+    def lookup(hostname):
+        done.put((hostname, _resolves(hostname)))
+
+    found = {}
+    waiting = list(hostnames)
+    running = {}  # hostname: when its lookup started
+    done = Queue()
+    while waiting or running:
+        while waiting and len(running) < jobs:
+            hostname = waiting.pop(0)
+            t = threading.Thread(target=lookup, args=(hostname,))
+            t.daemon = True
+            running[hostname] = time.time()
+            t.start()
+
+        wait = min(running.values()) + timeout - time.time()
+        try:
+            hostname, ok = done.get(timeout=max(wait, 0.001))
+            if hostname in running:  # not one we've given up on
+                del running[hostname]
+                found[hostname] = ok
+        except Empty:
+            for hostname, started in list(running.items()):
+                if time.time() - started >= timeout:
+                    del running[hostname]
+                    found[hostname] = False
+    return found
+
+
+def _resolves(hostname=None):
+    try:
+        socket.gethostbyname(hostname)
+    except (socket.error, UnicodeError):  # UnicodeError: not a hostname
+        return False
+    return True
+
+
 def file_exists(pathname=None):
     try:
         os.stat(pathname)
@@ -43,6 +135,60 @@ def file_exists(pathname=None):
     return
 
 
+def state_path(name=None, ext='json'):
+    '''
+Return the pathname of a state file in ${conf/state_dir}. State is kept per
+automount container so that --mode runs don't trample each other.
+    '''
+    tag = conf.c['am_container'].lower().encode('utf-8')
+    tag = hashlib.sha1(tag).hexdigest()[:12]
+    return '{0}/{1}-{2}.{3}'.format(conf.c['state_dir'], name, tag, ext)
+
+
+def read_json(pathname=None):
+    ''' Return the contents of a JSON state file, or None. '''
+    try:
+        f = open(pathname)
+        data = json.load(f)
+        f.close()
+    except (IOError, ValueError):
+        return None
+    return json_str(data)
+
+
+def json_str(obj):
+    ''' json hands back unicode on Python 2. The rest of ampush uses str. '''
+    if isinstance(obj, dict):
+        return dict((json_str(k), json_str(v)) for k, v in obj.items())
+    if isinstance(obj, list):
+        return [json_str(x) for x in obj]
+    if obj.__class__.__name__ == 'unicode':
+        return obj.encode('utf-8')
+    return obj
+
+
+def write_json(pathname=None, data=None):
+    ''' Replace a JSON state file. Failure is logged, not fatal. '''
+    tmp = pathname + '.tmp'
+    try:
+        if not file_exists(os.path.dirname(pathname)):
+            os.makedirs(os.path.dirname(pathname))
+        f = open(tmp, 'w')
+        json.dump(data, f)
+        f.close()
+        os.rename(tmp, pathname)
+    except (IOError, OSError) as e:
+        log_msg = 'Unable to write state file {0}: {1}'.format(pathname, e)
+        log.m.warning(log_msg)
+    return
+
+
+def map_hash(in_d=None):
+    ''' Return a content hash of a parsed automount map. '''
+    dumped = json.dumps(in_d, sort_keys=True, default=lambda e: e.as_dict())
+    return hashlib.sha1(dumped.encode('utf-8')).hexdigest()
+
+
 def verify_ff_am_dir_exists():
     t = conf.c['flat_file_map_dir']
     if file_exists(t) is not True:
@@ -91,7 +237,7 @@ def dry_msg(in_str=None, dry_run=None):
 
 def validate_mount_options(opt_str=None, map_name=None, am_key=None):
     ''' Rudimentary validation. Tweak to taste. '''
-    if not re.match(r'^-.*$', opt_str):
+    if not _MOUNT_OPTIONS.match(opt_str):
         log_msg = 'Terminating. Bad mount options in {0}/{1}: {2}'
         log_msg = log_msg.format(map_name, am_key, opt_str)
         log.m.critical(log_msg)
@@ -114,7 +260,7 @@ or three components (key + mount options + server:path).
         exit(8)
 
     # the last chunk should contain a server:path pair
-    if not re.match(r'.*:.*', in_list[-1]):
+    if not _SERVER_PATH.match(in_list[-1]):
         log_msg = 'Terminating. No server:path specified in {0}:{1}'
         log_msg = log_msg.format(map_name, am_key)
         log.m.critical(log_msg)
@@ -125,11 +271,11 @@ or three components (key + mount options + server:path).
 
 def strip_slash(in_str):
     ''' Strip leading slash from a string. '''
-    return re.sub(r'^/', '', in_str)
+    return _SLASH.sub('', in_str)
 
 
 def has_slash_prefix(in_str):
-    if re.match(r'^/.*', in_str):
+    if _SLASH.match(in_str):
         return True
     else:
         return False
@@ -146,7 +292,7 @@ def master_map_sanity_checks(map_dict=None, map_type=None):
         joined = '{0} {1}'.format(k, v['map'])
 
         # required: leading slash for all entries
-        if not re.match(r'^/', k):
+        if not _SLASH.match(k):
             log_msg = 'Terminating. No leading slash in {1} {2}:{3}'
             log_msg = log_msg.format(map_type, map_name, joined)
             log.m.critical(log_msg)
@@ -163,6 +309,10 @@ def master_map_sanity_checks(map_dict=None, map_type=None):
     return
 
 
+def _entry_text(k, v):
+    return '{0} {1}:{2}'.format(k, v['server_hostname'], v['server_dir'])
+
+
 def submap_sanity_checks(map_dict=None, map_name=None, map_type=None):
     if map_dict is None:
         log_msg = 'Nonexistent {0} map {1}. Skipping validation.'
@@ -170,24 +320,23 @@ def submap_sanity_checks(map_dict=None, map_name=None, map_type=None):
         log.m.debug(log_msg)
         return
 
+    direct_map_name = conf.c['direct_map_name']
     for k, v in map_dict.items():
-        joined = '{0} {1}:{2}'.format(k, v['server_hostname'], v['server_dir'])
-
-        if not re.match(r'.*\..*', v['server_hostname']):
-            log.m.warning('Non-FQHN found: ' + joined)
+        if not _FQHN.match(v['server_hostname']):
+            log.m.warning('Non-FQHN found: ' + _entry_text(k, v))
 
         if 'options' not in v:
-            log_msg = 'No mount options specified: ' + joined
+            log_msg = 'No mount options specified: ' + _entry_text(k, v)
             log.m.warning(log_msg)
 
         '''
 direct map keys are absolute filesystem paths, so verify that a leading
 slash is present
         '''
-        if k == conf.c['direct_map_name']:
-            if not re.match(r'^/', k):
+        if k == direct_map_name:
+            if not _SLASH.match(k):
                 log_msg = 'Terminating. No leading slash in direct map key: ' \
-                          + joined
+                          + _entry_text(k, v)
                 log.m.critical(log_msg)
                 print(log_msg)
                 exit(1)
@@ -197,37 +346,31 @@ slash is present
 def map_to_text(in_d=None, map_name=None):
     l = []
     for k, v in in_d.items():
-        if 'options' not in v:
-            opts = ''
-        else:
-            opts = v['options']
-
-        if map_name == conf.c['master_map_name']:
-            s = "{0}\t\t{1}\t{2}"
-            s = s.format(k,
-                         v['map'],
-                         opts)
-        else:
-            s = "{0}\t\t{1} {2}:{3}"
-            s = s.format(k,
-                         opts,
-                         v['server_hostname'],
-                         v['server_dir'])
-        l.append(s)
+        l.append(entry_to_text(k=k, v=v, map_name=map_name))
     return l
 
 
+def entry_to_text(k=None, v=None, map_name=None):
+    ''' Format one parsed entry the way it'd appear in a flat file map. '''
+    opts = v.get('options') or ''  # None: no mount options
+
+    if map_name == conf.c['master_map_name']:
+        s = "{0}\t\t{1}\t{2}"
+        s = s.format(k,
+                     v['map'],
+                     opts)
+    else:
+        s = "{0}\t\t{1} {2}:{3}"
+        s = s.format(k,
+                     opts,
+                     v['server_hostname'],
+                     v['server_dir'])
+    return s
+
+
 def ff_map_to_list(pathname=None):
-    out = []
+    ''' Return a flat file map's lines, minus comments and blank lines. '''
     f = open(pathname)
-
-    for l in f:
-        l.rstrip()  # chomp
-        # skip comments and blank lines
-        if re.match(r'^#', l):
-            continue
-        if len(l) < 2:
-            continue
-        out.append(l)
+    lines = f.read().splitlines()
     f.close()
-    return out
+    return [l for l in lines if l[:1] != '#' and not l.isspace() and l]
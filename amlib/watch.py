@@ -0,0 +1,209 @@
+import os
+import time
+import errno
+import select
+import struct
+import ctypes
+import ctypes.util
+import ldap
+from amlib import conf, log, sync
+
+'''
+ampush --watch: sync once, then watch ${ampush.conf/flat_file_map_dir}
+(and the directories under it, as file_map reads those too) and sync just
+the maps whose files change, as they change. A burst of changes
+(a git checkout, say) is collected until the directory has been quiet for
+${ampush.conf/watch_debounce} seconds, then synced in one pass.
+
+Linux inotify is used through ctypes, so nothing extra needs installing.
+Where it isn't available the directory is polled every
+${ampush.conf/watch_interval} seconds instead.
+
+Part of ampush. https://github.com/sfu-rcg/ampush
+Copyright (C) 2016-2017 Research Computing Group, Simon Fraser University.
+'''
+
+# from <sys/inotify.h>
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_ISDIR = 0x40000000
+
+WATCH_MASK = IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | \
+    IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF
+_EVENT = struct.Struct('iIII')  # wd, mask, cookie, len; then len bytes name
+
+
+class Inotify(object):
+    '''
+Changes to the files in a directory tree, from Linux inotify. Each
+directory needs a watch of its own; new ones are watched as they appear.
+    '''
+
+    def __init__(self, pathname=None):
+        self.libc = ctypes.CDLL(ctypes.util.find_library('c'),
+                                use_errno=True)
+        self.fd = self.libc.inotify_init()
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init failed')
+        self.dirs = {}  # watch descriptor: directory
+        try:
+            self._watch_tree(pathname)
+        except OSError:
+            os.close(self.fd)
+            raise
+
+    def close(self):
+        os.close(self.fd)
+        return
+
+    def _watch_tree(self, pathname=None):
+        ''' Watch pathname and every directory under it. Return the files. '''
+        filenames = set()
+        for root, subdirs, names in os.walk(pathname):
+            wd = self.libc.inotify_add_watch(self.fd, root.encode('utf-8'),
+                                             WATCH_MASK)
+            if wd < 0:
+                raise OSError(ctypes.get_errno(), 'inotify_add_watch failed')
+            self.dirs[wd] = root
+            filenames.update(names)
+        return filenames
+
+    def changes(self, timeout=None):
+        '''
+Wait up to timeout seconds (None: forever) for changes. Return the set of
+names changed, or None if they can't be known and everything should be
+looked at: events were dropped, or the directory itself was replaced.
+        '''
+        try:
+            ready = select.select([self.fd], [], [], timeout)[0]
+        except select.error as e:
+            if e.args[0] == errno.EINTR:
+                return set()
+            raise
+        if not ready:
+            return set()
+
+        buf = os.read(self.fd, 65536)
+        names = set()
+        offset = 0
+        while offset < len(buf):
+            wd, mask, cookie, length = _EVENT.unpack_from(buf, offset)
+            offset += _EVENT.size
+            name = buf[offset:offset + length].rstrip(b'\0')
+            offset += length
+            if mask & (IN_Q_OVERFLOW | IN_DELETE_SELF | IN_MOVE_SELF):
+                return None
+            if not name:
+                continue
+            name = name.decode('utf-8')
+            if mask & IN_ISDIR and mask & (IN_CREATE | IN_MOVED_TO):
+                # its files may have been written before we watched it
+                try:
+                    names.update(self._watch_tree(
+                        os.path.join(self.dirs[wd], name)))
+                except (OSError, KeyError):
+                    return None
+            names.add(name)
+        return names
+
+
+class Poller(object):
+    ''' Changes to the files in a directory tree, by comparing stat()s. '''
+
+    def __init__(self, pathname=None):
+        self.pathname = pathname
+        self.interval = float(conf.c['watch_interval'])
+        self.seen = self._scan()
+
+    def close(self):
+        return
+
+    def _scan(self):
+        ''' Return {pathname: (mtime, size)} for every file in the tree. '''
+        found = {}
+        for root, subdirs, names in os.walk(self.pathname):
+            for name in names:
+                pathname = os.path.join(root, name)
+                try:
+                    st = os.stat(pathname)
+                except OSError:  # gone since os.walk listed it
+                    continue
+                found[pathname] = (st.st_mtime, st.st_size)
+        return found
+
+    def changes(self, timeout=None):
+        if timeout is None or timeout > self.interval:
+            timeout = self.interval
+        time.sleep(timeout)
+        now = self._scan()
+        changed = set(self.seen) ^ set(now)
+        changed.update([k for k in now if k in self.seen and
+                        self.seen[k] != now[k]])
+        self.seen = now
+        return set([os.path.basename(k) for k in changed])
+
+
+def watcher(pathname=None):
+    ''' Return an Inotify for pathname if we can, or else a Poller. '''
+    try:
+        return Inotify(pathname)
+    except (OSError, AttributeError) as e:  # AttributeError: not Linux
+        log_msg = 'inotify unavailable ({0}); polling {1} every {2}s'
+        log.m.info(log_msg.format(e, pathname, conf.c['watch_interval']))
+        return Poller(pathname)
+
+
+def run(dry_run=True, jobs=1):
+    ''' Sync everything, then keep syncing what changes. Never returns. '''
+    map_dir = conf.c['flat_file_map_dir']
+    w = watcher(map_dir)
+    debounce = float(conf.c['watch_debounce'])
+
+    _pass(map_names=None, dry_run=dry_run, jobs=jobs)
+    log.m.info('Watching {0} for changes'.format(map_dir))
+    while True:
+        changed = w.changes()
+        if changed is not None and len(changed) == 0:
+            continue
+
+        # wait for the burst to end
+        while True:
+            more = w.changes(timeout=debounce)
+            if more is not None and len(more) == 0:
+                break
+            if changed is None or more is None:
+                changed = None
+            else:
+                changed.update(more)
+
+        if changed is None:
+            log.m.info('Lost track of changes; syncing every map')
+            w.close()
+            w = watcher(map_dir)
+        _pass(map_names=changed, dry_run=dry_run, jobs=jobs)
+    return
+
+
+def _pass(map_names=None, dry_run=True, jobs=1):
+    '''
+A bad edit, AD refusing a write, or the DCs being out of reach shouldn't
+stop the watch: log it and wait for the next change.
+    '''
+    try:
+        sync.watch_pass(map_names=map_names, dry_run=dry_run, jobs=jobs)
+    except SystemExit as e:
+        log_msg = 'Sync stopped with exit code {0}; waiting for the next ' + \
+                  'change'
+        log.m.error(log_msg.format(e.code))
+    except ldap.LDAPError as e:  # cnx has run out of retries
+        log_msg = 'Sync stopped by {0}: {1}; waiting for the next change'
+        log.m.error(log_msg.format(e.__class__.__name__, e))
+    except Exception:
+        log.m.exception('Sync failed; waiting for the next change')
+    return
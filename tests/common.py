@@ -0,0 +1,68 @@
+'''
+Shared by the tests: configuration without an ampush.conf, logging set up
+once per process however many tests call configure(), and scenarios run
+against the fake AD in a process of their own.
+'''
+import os
+from multiprocessing import Process, Queue
+from amlib import conf, log, fake_ad, cnx
+
+CONTAINER = 'CN=automounts,OU=Unix,' + fake_ad.NC
+_logging = False
+
+
+def configure(**settings):
+    ''' Stand in for conf.load(), like ambench's; settings override. '''
+    global _logging
+    conf.c.clear()
+    conf.c.update(conf.defaults)
+    conf.c.update({'am_container_default': CONTAINER,
+                   'flat_file_map_dir': '/nonexistent',
+                   'state_dir': '/nonexistent',
+                   'master_map_name': 'auto.master',
+                   'direct_map_name': 'auto.direct',
+                   't_nisobj': 'nisObject',
+                   't_nismap': 'nisMap',
+                   'ad_domain': 'test.example.com',
+                   'am_user': 'ampusher',
+                   'am_pass': '',
+                   'replication_wait_time': '0',
+                   'check_hostnames': '0',
+                   'main_loglevel': '40',
+                   'modes': [None]})
+    conf.c.update(settings)
+    conf.use_mode(None)
+    if _logging is False:
+        log.setup(logfile=False)
+        _logging = True
+    return
+
+
+def _child(scenario=None, tmp=None, results=None):
+    map_dir = os.path.join(tmp, 'maps')
+    fake_ad.write_maps(pathname=map_dir, maps=2, entries=5)
+    configure(flat_file_map_dir=map_dir,
+              state_dir=os.path.join(tmp, 'state'))
+    ad = fake_ad.FakeDirectory(container=CONTAINER)
+    cnx.use_factory(ad.connect)
+    try:
+        results.put(scenario(ad=ad, map_dir=map_dir))
+    except BaseException as e:
+        results.put(repr(e))
+    return
+
+
+def run_scenario(scenario=None, tmp=None):
+    '''
+Return what scenario(ad, map_dir) returns, run in a new process against a
+fresh FakeDirectory and two maps of five entries written under tmp. Like
+ambench, each scenario gets its own process: ampush keeps its
+connections, snapshot and manifest in module globals for the whole run.
+    '''
+    results = Queue()
+    proc = Process(target=_child, kwargs={'scenario': scenario, 'tmp': tmp,
+                                          'results': results})
+    proc.start()
+    r = results.get()
+    proc.join()
+    return r
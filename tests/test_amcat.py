@@ -0,0 +1,97 @@
+'''
+amcat's --format flat, ldif and json, read from the fake AD after a push.
+Run with python -m unittest discover -s tests
+'''
+import os
+import json
+import shutil
+import tempfile
+import unittest
+from Queue import Queue
+from amlib import sync
+from common import run_scenario, CONTAINER
+
+# amcat is a script, not a module; load it without running main()
+AMCAT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..',
+                     'amcat')
+amcat = type(os)('amcat')
+amcat.__file__ = AMCAT
+f = open(AMCAT)
+exec(compile(f.read(), AMCAT, 'exec'), amcat.__dict__)
+f.close()
+
+
+def read(map_name=None, fmt=None):
+    ''' Return the lines amcat would print for map_name. '''
+    out = Queue()
+    amcat.read_map(map_name, fmt, out, False)
+    lines = []
+    while True:
+        line = out.get()
+        if line is amcat.DONE:
+            return lines
+        elif line is amcat.MISSING:
+            lines.append('MISSING')
+        elif isinstance(line, BaseException):
+            raise line
+        else:
+            lines.append(line)
+
+
+def cat(ad=None, map_dir=None):
+    sync.do(maps=None, dry_run=False, full=False, jobs=1)
+    f = open(os.path.join(map_dir, 'auto.bench0'))
+    ff_lines = f.read().splitlines()
+    f.close()
+    return {'maps': amcat.list_maps(),
+            'ff': ff_lines,
+            'flat': read(map_name='auto.bench0', fmt='flat'),
+            'ldif': read(map_name='auto.bench0', fmt='ldif'),
+            'json': read(map_name='auto.bench0', fmt='json'),
+            'missing': read(map_name='auto.nope', fmt='flat')}
+
+
+class AmcatTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        tmp = tempfile.mkdtemp(prefix='ampush-test.')
+        try:
+            cls.out = run_scenario(scenario=cat, tmp=tmp)
+        finally:
+            shutil.rmtree(tmp)
+
+    def test_list_maps(self):
+        self.assertEqual(self.out['maps'],
+                         ['auto.master', 'auto.bench0', 'auto.bench1'])
+
+    def test_flat(self):
+        self.assertEqual(self.out['flat'][0], '\n### AD:auto.bench0')
+        self.assertEqual([line.split() for line in self.out['flat'][1:]],
+                         [line.split() for line in self.out['ff']])
+
+    def test_ldif(self):
+        records = self.out['ldif']
+        self.assertEqual([r.splitlines()[0].lower() for r in records],
+                         [('dn: CN=auto.bench0,' + CONTAINER).lower()] +
+                         [('dn: CN=key{0},CN=auto.bench0,{1}'.format(
+                             i, CONTAINER)).lower() for i in range(5)])
+        for r in records:
+            self.assertTrue(r.endswith('\n') and not r.endswith('\n\n'))
+
+    def test_json(self):
+        entries = [json.loads(line) for line in self.out['json']]
+        self.assertEqual([(e['map_name'], e['key']) for e in entries],
+                         [('auto.bench0', 'key{0}'.format(i))
+                          for i in range(5)])
+        for e, ff_line in zip(entries, self.out['ff']):
+            self.assertEqual(ff_line.split()[-1],
+                             '{0}:{1}'.format(e['server_hostname'],
+                                              e['server_dir']))
+
+    def test_missing(self):
+        self.assertEqual(self.out['missing'], ['MISSING'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,168 @@
+'''
+cnx.Connection: reconnecting and retrying when the DC goes away, whether
+it's the call or the bind that fails; cnx._locate(): keeping one DC.
+Run with python -m unittest discover -s tests
+'''
+import time
+import unittest
+import ldap
+from amlib import cnx
+from common import configure
+
+
+class Flaky(object):
+    ''' LDAPObject stand-in whose search_s fails the first `fails` times. '''
+
+    def __init__(self, fails=0, error=ldap.SERVER_DOWN):
+        self.fails = fails
+        self.error = error
+        self.calls = 0
+
+    def search_s(self, *args, **kwargs):
+        self.calls += 1
+        if self.calls <= self.fails:
+            raise self.error({'desc': "Can't contact LDAP server"})
+        return [('CN=x', {})]
+
+    def unbind_s(self):
+        return
+
+
+class RetryTest(unittest.TestCase):
+
+    def setUp(self):
+        configure(ldap_retries='2')
+        self.sleeps = []
+        self._sleep = time.sleep
+        time.sleep = self.sleeps.append
+        self.binds = 0
+
+    def tearDown(self):
+        time.sleep = self._sleep
+        cnx.use_factory(None)
+
+    def factory(self, directory=None, bind_fails=0):
+        ''' Use directory; the first bind_fails binds fail. '''
+        def connect():
+            self.binds += 1
+            if self.binds <= bind_fails:
+                raise ldap.SERVER_DOWN({'desc': "Can't contact LDAP server"})
+            return directory
+        cnx.use_factory(connect)
+        return
+
+    def test_call_retried(self):
+        directory = Flaky(fails=1)
+        self.factory(directory)
+        conn = cnx.Connection()
+        self.assertEqual(conn.search_s('CN=x'), [('CN=x', {})])
+        self.assertEqual(directory.calls, 2)
+        self.assertEqual(self.binds, 2)
+        self.assertEqual(conn.reconnects, 1)
+        self.assertEqual(conn.generation, 1)
+        self.assertEqual(self.sleeps, [1])
+
+    def test_bind_retried(self):
+        directory = Flaky()
+        self.factory(directory, bind_fails=2)
+        conn = cnx.Connection()
+        self.assertEqual(conn.search_s('CN=x'), [('CN=x', {})])
+        self.assertEqual(self.binds, 3)
+        self.assertEqual(directory.calls, 1)
+        self.assertEqual(conn.errors, 2)
+        self.assertEqual(self.sleeps, [1, 2])
+
+    def test_gives_up(self):
+        self.factory(Flaky(fails=10, error=ldap.TIMEOUT))
+        conn = cnx.Connection()
+        self.assertRaises(ldap.TIMEOUT, conn.search_s, 'CN=x')
+        self.assertEqual(conn.errors, 3)
+        self.assertEqual(conn.reconnects, 2)
+        self.assertEqual(self.sleeps, [1, 2])
+
+    def test_other_errors_not_retried(self):
+        directory = Flaky(fails=1, error=ldap.NO_SUCH_OBJECT)
+        self.factory(directory)
+        conn = cnx.Connection()
+        self.assertRaises(ldap.NO_SUCH_OBJECT, conn.search_s, 'CN=x')
+        self.assertEqual(directory.calls, 1)
+        self.assertEqual(conn.reconnects, 0)
+        self.assertEqual(self.sleeps, [])
+
+
+class Binds(cnx.Connection):
+    ''' Connection that records what each bind was told was unreachable. '''
+
+    def __init__(self, directory=None, bind_fails=0):
+        cnx.Connection.__init__(self)
+        self.directory = directory
+        self.bind_fails = bind_fails
+        self.told = []
+
+    def _bind(self, unreachable=None):
+        self.told.append(unreachable)
+        self.server = 'dc1'
+        if len(self.told) <= self.bind_fails:
+            raise ldap.SERVER_DOWN({'desc': "Can't contact LDAP server"})
+        self.l = self.directory
+        return
+
+
+class Locator(object):
+    ''' python-ad's Locator, with DNS answering dc1 then dc2. '''
+
+    def locate(self, domain=None):
+        return 'dc1'
+
+    def locate_many(self, domain=None):
+        return ['dc1', 'dc2']
+
+
+class LocateTest(unittest.TestCase):
+
+    def setUp(self):
+        configure(ldap_retries='2')
+        self._sleep = time.sleep
+        time.sleep = lambda seconds: None
+        self._locator = getattr(cnx, 'Locator', None)
+        cnx.Locator = Locator
+        cnx._server = None
+
+    def tearDown(self):
+        time.sleep = self._sleep
+        cnx.Locator = self._locator
+        cnx._server = None
+
+    def test_same_dc_for_the_run(self):
+        self.assertEqual(cnx._locate(), 'dc1')
+        self.assertEqual(cnx._locate(), 'dc1')
+        # another thread has already failed over from dc0
+        self.assertEqual(cnx._locate(unreachable='dc0'), 'dc1')
+
+    def test_fail_over(self):
+        cnx._locate()
+        self.assertEqual(cnx._locate(unreachable='dc1'), 'dc2')
+        self.assertEqual(cnx._locate(), 'dc2')
+
+    def test_ad_server_always_used(self):
+        configure(ad_server='dc9')
+        self.assertEqual(cnx._locate(), 'dc9')
+        self.assertEqual(cnx._locate(unreachable='dc9'), 'dc9')
+
+    def test_failed_call_reconnects_to_same_dc(self):
+        conn = Binds(Flaky(fails=1))
+        self.assertEqual(conn.search_s('CN=x'), [('CN=x', {})])
+        self.assertEqual(conn.told, [None, None])
+
+    def test_failed_bind_fails_over(self):
+        conn = Binds(Flaky(), bind_fails=1)
+        self.assertEqual(conn.search_s('CN=x'), [('CN=x', {})])
+        self.assertEqual(conn.told, [None, 'dc1'])
+
+        conn = Binds(Flaky(fails=1), bind_fails=1)
+        self.assertEqual(conn.search_s('CN=x'), [('CN=x', {})])
+        self.assertEqual(conn.told, [None, 'dc1', None])
+
+
+if __name__ == '__main__':
+    unittest.main()
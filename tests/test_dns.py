@@ -0,0 +1,74 @@
+'''
+utils.check_hostnames() and _lookups(): lookups in parallel, each with its
+own timeout, and the cache of names that resolved.
+Run with python -m unittest discover -s tests
+'''
+import os
+import time
+import shutil
+import tempfile
+import threading
+import unittest
+from amlib import utils
+from common import configure
+
+
+class LookupsTest(unittest.TestCase):
+    '''
+utils._resolves() is replaced: names starting "slow" hang until the test
+is over, names starting "bad" don't resolve, and the rest do.
+    '''
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp(prefix='ampush-test.')
+        configure(state_dir=self.tmp, dns_timeout='0.2', dns_jobs='2')
+        self.asked = []
+        self.over = threading.Event()
+        self._resolves = utils._resolves
+        utils._resolves = self.resolves
+
+    def tearDown(self):
+        self.over.set()
+        utils._resolves = self._resolves
+        shutil.rmtree(self.tmp)
+
+    def resolves(self, hostname=None):
+        self.asked.append(hostname)
+        if hostname.startswith('slow'):
+            self.over.wait()
+        return not hostname.startswith('bad')
+
+    def test_answers(self):
+        found = utils._lookups(hostnames=['a', 'bad1', 'b', 'bad2'], jobs=2,
+                               timeout=5)
+        self.assertEqual(found, {'a': True, 'bad1': False, 'b': True,
+                                 'bad2': False})
+
+    def test_each_lookup_times_out_on_its_own(self):
+        start = time.time()
+        found = utils._lookups(hostnames=['slow1', 'a', 'slow2', 'b'],
+                               jobs=1, timeout=0.2)
+        took = time.time() - start
+        self.assertEqual(found, {'slow1': False, 'a': True, 'slow2': False,
+                                 'b': True})
+        self.assertTrue(0.4 <= took < 2, took)
+
+    def test_slow_lookup_holds_up_nobody(self):
+        start = time.time()
+        found = utils._lookups(hostnames=['slow1'] + list('abcdefgh'),
+                               jobs=2, timeout=0.5)
+        self.assertEqual(found['slow1'], False)
+        self.assertEqual(len([h for h in found if found[h] is True]), 8)
+        self.assertTrue(time.time() - start < 2)
+
+    def test_cache(self):
+        hosts = {'a': ['auto.x'], 'slow1': ['auto.x', 'auto.y']}
+        self.assertRaises(SystemExit, utils.check_hostnames, hosts)
+        self.assertTrue(os.path.exists(os.path.join(self.tmp, 'dns.json')))
+        self.asked = []
+        utils.check_hostnames({'a': ['auto.x']})
+        self.assertEqual(self.asked, [])
+
+
+if __name__ == '__main__':
+    unittest.main()
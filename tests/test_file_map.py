@@ -0,0 +1,53 @@
+'''
+file_map.parse_submap(): the _SUBMAP_ENTRY fast path, and lines it leaves
+to _parse_submap_line().
+Run with python -m unittest discover -s tests
+'''
+import unittest
+from amlib import file_map as fm
+from common import configure
+
+
+class ParseSubmapTest(unittest.TestCase):
+
+    def setUp(self):
+        configure()
+
+    def parse(self, line=None):
+        return fm.parse_submap(map_name='auto.t', map_lines=[line])
+
+    def test_regex_matches_line_parser(self):
+        for line in ['apps -tcp,vers=3 nfs1.example.com:/exports/apps',
+                     'data nfs2.example.com:/srv/data',
+                     'tabs\t-rw,intr\tnfs3.example.com:/tabs  ',
+                     '  lead -ro nfs4.example.com:/lead']:
+            self.assertTrue(fm._SUBMAP_ENTRY.match(line) is not None, line)
+            d_map = self.parse(line)
+            am_key, expected = fm._parse_submap_line(map_name='auto.t',
+                                                     line=line)
+            self.assertEqual(list(d_map.keys()), [am_key])
+            self.assertEqual(d_map[am_key].as_dict(), expected.as_dict())
+
+    def test_fallback_extra_colon(self):
+        line = 'k -rw nfs1.example.com:/x:y'
+        self.assertTrue(fm._SUBMAP_ENTRY.match(line) is None)
+        self.assertEqual(self.parse(line)['k'].as_dict(),
+                         {'server_hostname': 'nfs1.example.com',
+                          'server_dir': '/x',
+                          'options': '-rw'})
+
+        line = 'k nfs1.example.com:/a:b'
+        self.assertTrue(fm._SUBMAP_ENTRY.match(line) is None)
+        self.assertEqual(self.parse(line)['k'].as_dict(),
+                         {'server_hostname': 'nfs1.example.com',
+                          'server_dir': '/a',
+                          'options': None})
+
+    def test_fallback_rejects_bad_line(self):
+        line = 'k -rw nfs1.example.com:/x extra'
+        self.assertTrue(fm._SUBMAP_ENTRY.match(line) is None)
+        self.assertRaises(SystemExit, self.parse, line)
+
+
+if __name__ == '__main__':
+    unittest.main()
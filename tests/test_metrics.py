@@ -0,0 +1,82 @@
+'''
+metrics: counting by map and phase, and the JSON and node_exporter
+textfile written at the end of a run.
+Run with python -m unittest discover -s tests
+'''
+import os
+import json
+import shutil
+import tempfile
+import unittest
+from amlib import metrics, utils
+from common import configure
+
+
+class MetricsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp(prefix='ampush-test.')
+        configure(state_dir=self.tmp, metrics_textfile_dir=self.tmp)
+        metrics.reset()
+
+    def tearDown(self):
+        metrics.reset()
+        shutil.rmtree(self.tmp)
+
+    def count_some(self):
+        with metrics.phase('ad_read'):
+            metrics.count('search')
+            with metrics.phase('write', map_name='auto.a"b'):
+                metrics.count('add', 2)
+                metrics.count('modify')
+                metrics.count('unlisted')
+            metrics.count('entries', 5)
+        return
+
+    def test_counts(self):
+        self.count_some()
+        totals = metrics.totals()
+        self.assertEqual([totals[m] for m in
+                          ['search', 'add', 'modify', 'unlisted', 'entries']],
+                         [1, 2, 1, 1, 5])
+        self.assertEqual(sorted(metrics._counts.keys()),
+                         [('', 'ad_read'), ('auto.a"b', 'write')])
+        metrics.reset()
+        self.assertEqual(metrics.totals(), {})
+
+    def test_json(self):
+        self.count_some()
+        metrics.write()
+        f = open(utils.state_path('metrics'))
+        run = json.load(f)
+        f.close()
+        self.assertEqual(run['mode'], 'default')
+        self.assertEqual(run['totals']['unlisted'], 1)
+        self.assertEqual([(r['map'], r['phase'], r['metrics'].get('add'))
+                          for r in run['maps']],
+                         [('', 'ad_read', None), ('auto.a"b', 'write', 2)])
+
+    def test_textfile(self):
+        self.count_some()
+        metrics.write(name='apply')
+        self.assertEqual(sorted(os.listdir(self.tmp)),
+                         ['ampush-apply.prom',
+                          os.path.basename(utils.state_path('metrics'))])
+        f = open(os.path.join(self.tmp, 'ampush-apply.prom'))
+        lines = f.read().splitlines()
+        f.close()
+        self.assertEqual(len([l for l in lines if l.startswith(
+            '# TYPE ampush_ldap_operations ')]), 1)
+        self.assertTrue('ampush_ldap_operations{mode="apply",' +
+                        'map="auto.a\\"b",phase="write",op="add"} 2'
+                        in lines)
+        self.assertTrue('ampush_ldap_entries{mode="apply",map="",' +
+                        'phase="ad_read"} 5' in lines)
+        self.assertEqual([l for l in lines if 'unlisted' in l], [])
+        for line in lines:
+            if not line.startswith('#'):
+                float(line.rsplit(' ', 1)[1])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,147 @@
+'''
+pipeline.Pipeline: the window, waiting on related DNs, and re-sending
+what was outstanding when the connection was lost.
+Run with python -m unittest discover -s tests
+'''
+import unittest
+import ldap
+from amlib import pipeline
+from common import configure
+
+C = 'CN=automounts,DC=example,DC=com'
+
+
+class Wire(object):
+    '''
+A connection that logs what is sent and collected, and fails as told:
+fail maps a DN to the LDAPError its result raises; lose is how many
+result3() calls raise SERVER_DOWN before any result comes back.
+    '''
+
+    def __init__(self, fail=None, lose=0):
+        self.fail = fail or {}
+        self.lose = lose
+        self.log = []
+        self.sent = {}  # msgid: dn
+        self.msgid = 0
+        self.most = 0   # most operations outstanding at once
+
+    def _send(self, op=None, dn=None):
+        self.msgid += 1
+        self.sent[self.msgid] = dn
+        self.log.append(('send', op, dn))
+        self.most = max(self.most, len(self.sent))
+        return self.msgid
+
+    def add_ext(self, dn=None, modlist=None):
+        return self._send('add', dn)
+
+    def modify_ext(self, dn=None, modlist=None):
+        return self._send('modify', dn)
+
+    def delete_ext(self, dn=None):
+        return self._send('delete', dn)
+
+    def result3(self, msgid=None):
+        if self.lose > 0:
+            self.lose -= 1
+            self.sent.clear()
+            raise ldap.SERVER_DOWN({'desc': "Can't contact LDAP server"})
+        dn = self.sent.pop(msgid)
+        self.log.append(('result', dn))
+        if dn in self.fail:
+            raise self.fail[dn]
+        return ldap.RES_ADD, [], msgid, []
+
+    def search_ext_s(self, base=None, scope=None, filterstr=None,
+                     attrs=None):
+        self.log.append(('search', base))
+        return []
+
+
+def dn(key=None, map_name='auto.t'):
+    if key is None:
+        return 'CN={0},{1}'.format(map_name, C)
+    return 'CN={0},CN={1},{2}'.format(key, map_name, C)
+
+
+class PipelineTest(unittest.TestCase):
+
+    def setUp(self):
+        configure()
+        self.done = []
+
+    def pipeline(self, wire=None, window=32, retries=3):
+        return pipeline.Pipeline(conn=wire, window=window, retries=retries,
+                                 on_done=lambda op, dn, args:
+                                 self.done.append((op, dn)))
+
+    def test_window(self):
+        wire = Wire()
+        p = self.pipeline(wire, window=2)
+        for key in 'abcde':
+            p.submit(op='add', dn=dn(key), args=[])
+        self.assertEqual(wire.most, 2)
+        self.assertEqual(len(p.pending), 2)
+        p.drain()
+        self.assertEqual(self.done, [('add', dn(key)) for key in 'abcde'])
+        self.assertEqual(p.submitted, 5)
+
+    def test_related_dns_wait(self):
+        wire = Wire()
+        p = self.pipeline(wire)
+        p.submit(op='add', dn=dn(), args=[])
+        p.submit(op='add', dn=dn('a', map_name='auto.u'), args=[])
+        p.submit(op='add', dn=dn('a'), args=[])  # waits for its map
+        p.submit(op='modify', dn=dn('b', map_name='auto.u'), args=[])
+        p.submit(op='delete', dn=dn())           # waits for its child
+        p.search(base=dn('a', map_name='auto.u'))
+        self.assertEqual(wire.log, [('send', 'add', dn()),
+                                    ('send', 'add', dn('a', 'auto.u')),
+                                    ('result', dn()),
+                                    ('send', 'add', dn('a')),
+                                    ('send', 'modify', dn('b', 'auto.u')),
+                                    ('result', dn('a', 'auto.u')),
+                                    ('result', dn('a')),
+                                    ('send', 'delete', dn()),
+                                    ('search', dn('a', 'auto.u'))])
+
+    def test_lost_connection_resends(self):
+        wire = Wire(lose=1)
+        p = self.pipeline(wire)
+        for key in 'abc':
+            p.submit(op='add', dn=dn(key), args=[])
+        p.drain()
+        self.assertEqual([x for x in wire.log if x[0] == 'send'],
+                         [('send', 'add', dn(key)) for key in 'abcabc'])
+        self.assertEqual(self.done, [('add', dn(key)) for key in 'abc'])
+        self.assertEqual(p.failures, [])
+
+    def test_lost_too_often(self):
+        wire = Wire(lose=10)
+        p = self.pipeline(wire, retries=2)
+        p.submit(op='add', dn=dn('a'), args=[])
+        p.submit(op='delete', dn=dn('b'))
+        p.drain()
+        self.assertEqual(len([x for x in wire.log if x[0] == 'send']), 6)
+        self.assertEqual([(op, d) for op, d, e in p.failures],
+                         [('add', dn('a')), ('delete', dn('b'))])
+        self.assertEqual(self.done, [])
+
+    def test_failures(self):
+        wire = Wire(fail={dn('a'): ldap.ALREADY_EXISTS({}),
+                          dn('b'): ldap.NO_SUCH_OBJECT({}),
+                          dn('c'): ldap.NO_SUCH_OBJECT({})})
+        p = self.pipeline(wire)
+        p.submit(op='add', dn=dn('a'), args=[])     # only a warning
+        p.submit(op='modify', dn=dn('b'), args=[])  # a failure
+        p.submit(op='delete', dn=dn('c'))           # only a warning
+        p.submit(op='add', dn=dn('d'), args=[])
+        p.drain()
+        self.assertEqual([(op, d) for op, d, e in p.failures],
+                         [('modify', dn('b'))])
+        self.assertEqual(self.done, [('add', dn('d'))])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,62 @@
+'''
+plan.diff(): what it takes to turn an AD map into a flat file map.
+Run with python -m unittest discover -s tests
+'''
+import unittest
+from amlib import plan
+from amlib.entry import MapEntry
+
+
+def entry(line=None):
+    ''' MapEntry from 'options server:/path' or 'server:/path'. '''
+    chunks = line.split()
+    server_hostname, server_dir = chunks[-1].split(':')
+    options = None
+    if len(chunks) > 1:
+        options = chunks[0]
+    return MapEntry(server_hostname, server_dir, options)
+
+
+class DiffTest(unittest.TestCase):
+
+    def test_in_sync(self):
+        ff_map = {'a': entry('-rw nfs1:/a'), 'b': entry('nfs2:/b')}
+        ad_map = {'a': entry('-rw nfs1:/a'), 'b': entry('nfs2:/b')}
+        p = plan.diff(map_name='auto.t', ff_map=ff_map, ad_map=ad_map)
+        self.assertEqual(len(p), 0)
+
+    def test_adds_deletes_modifies(self):
+        ff_map = {'keep': entry('nfs1:/keep'),
+                  'new': entry('-ro nfs1:/new'),
+                  'moved': entry('-rw nfs2:/moved')}
+        ad_map = {'keep': entry('nfs1:/keep'),
+                  'old': entry('nfs1:/old'),
+                  'moved': entry('-rw nfs1:/moved')}
+        p = plan.diff(map_name='auto.t', ff_map=ff_map, ad_map=ad_map)
+        self.assertEqual(p.deletes, ['old'])
+        self.assertEqual(p.adds, [('new', ff_map['new'])])
+        self.assertEqual(p.modifies,
+                         [('moved', ff_map['moved'], ad_map['moved'])])
+        self.assertEqual(len(p), 3)
+
+    def test_map_not_in_ad(self):
+        ff_map = {'b': entry('nfs1:/b'), 'a': entry('nfs1:/a')}
+        p = plan.diff(map_name='auto.t', ff_map=ff_map, ad_map=None)
+        self.assertEqual([k for k, v in p.adds], ['a', 'b'])
+        self.assertEqual(p.deletes, [])
+        self.assertEqual(p.modifies, [])
+
+    def test_munged_dict_fields_only(self):
+        # hook.munge may hand back plain dicts with fewer fields
+        ff_map = {'a': {'server_dir': '/a'}}
+        ad_map = {'a': entry('-rw nfs1:/a')}
+        p = plan.diff(map_name='auto.t', ff_map=ff_map, ad_map=ad_map)
+        self.assertEqual(len(p), 0)
+
+        ff_map = {'a': {'server_dir': '/elsewhere'}}
+        p = plan.diff(map_name='auto.t', ff_map=ff_map, ad_map=ad_map)
+        self.assertEqual([k for k, ff_v, ad_v in p.modifies], ['a'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,46 @@
+'''
+profiling: one set of reports per map and pass, and the summary.
+Run with python -m unittest discover -s tests
+'''
+import os
+import shutil
+import tempfile
+import unittest
+from amlib import profiling
+from common import configure
+
+
+class MapProfileTest(unittest.TestCase):
+
+    def setUp(self):
+        configure()
+        self.tmp = tempfile.mkdtemp(prefix='ampush-test.')
+        profiling.start(pathname=self.tmp)
+
+    def tearDown(self):
+        profiling._dir = None
+        profiling.reset()
+        shutil.rmtree(self.tmp)
+
+    def test_resync_kept_apart(self):
+        with profiling.map_profile(map_name='auto.home'):
+            sorted(range(1000))
+        with profiling.named_pass('resync'):
+            with profiling.map_profile(map_name='auto.home'):
+                sorted(range(1000))
+        profiling.write_summary()
+        self.assertEqual(sorted(os.listdir(self.tmp)),
+                         ['default.resync.auto.home.alloc.txt',
+                          'default.resync.auto.home.pstats',
+                          'default.sync.auto.home.alloc.txt',
+                          'default.sync.auto.home.pstats',
+                          'summary-default.txt'])
+        f = open(os.path.join(self.tmp, 'summary-default.txt'))
+        rows = [line.split()[:2] for line in f.readlines()[1:]]
+        f.close()
+        self.assertEqual(sorted(rows), [['auto.home', 'resync'],
+                                        ['auto.home', 'sync']])
+
+
+if __name__ == '__main__':
+    unittest.main()
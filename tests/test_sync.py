@@ -0,0 +1,163 @@
+'''
+sync.do() against the in-memory fake AD (amlib/fake_ad.py).
+Run with python -m unittest discover -s tests
+'''
+import os
+import json
+import signal
+import shutil
+import tempfile
+import unittest
+import ldap
+from amlib import sync, ad_op, metrics, utils, plan, conf
+from common import run_scenario, CONTAINER
+
+KEY0 = 'CN=key0,CN=auto.bench0,' + CONTAINER
+KEY1 = 'CN=key1,CN=auto.bench0,' + CONTAINER
+
+
+def push(dry_run=False):
+    sync.do(maps=None, dry_run=dry_run, full=False, jobs=1)
+    return
+
+
+def nis_map_entry(ad=None, dn=None):
+    rows = ad.search(base=dn, scope=ldap.SCOPE_BASE, attrs=['nisMapEntry'])
+    return rows[0][1]['nisMapEntry'][0]
+
+
+def first_push(ad=None, map_dir=None):
+    push()
+    f = open(os.path.join(map_dir, 'auto.bench0'))
+    line = f.readline().split(None, 1)[1]
+    f.close()
+    return [' '.join(line.split()),
+            ' '.join(nis_map_entry(ad=ad, dn=KEY0).split())]
+
+
+def manual_change(ad=None, map_dir=None):
+    push()
+    push()  # nothing to do; the manifest now has every map
+    seen = [nis_map_entry(ad=ad, dn=KEY0)]
+    ad.do(op='modify', dn=KEY0,
+          args=[(ldap.MOD_REPLACE, 'nisMapEntry', ['-ro hacked:/x'])])
+    push(dry_run=True)  # reads AD without repairing it
+    seen.append(nis_map_entry(ad=ad, dn=KEY0))
+    push()
+    seen.append(nis_map_entry(ad=ad, dn=KEY0))
+    return seen
+
+
+def watch_passes(ad=None, map_dir=None):
+    ''' Each --watch pass writes its own metrics and leaves no pipelines. '''
+    seen = []
+    for map_names in [None, ['auto.bench1']]:
+        sync.watch_pass(map_names=map_names, dry_run=False, jobs=2)
+        f = open(utils.state_path('metrics'))
+        written = json.load(f)['totals']
+        f.close()
+        seen.append((written.get('add', 0), written.get('search', 0) > 0,
+                     len(ad_op._pipes), len(metrics._counts)))
+    return seen
+
+
+def edit_map(map_dir=None):
+    ''' Point key0 and key1 of auto.bench0 somewhere new. '''
+    pathname = os.path.join(map_dir, 'auto.bench0')
+    f = open(pathname)
+    lines = f.readlines()
+    f.close()
+    lines[0] = 'key0 -rw nfsnew:/key0\n'
+    lines[1] = 'key1 -rw nfsnew:/key1\n'
+    f = open(pathname, 'w')
+    f.writelines(lines)
+    f.close()
+    return
+
+
+def plan_and_apply(ad=None, map_dir=None, hand_edit=False):
+    push()
+    edit_map(map_dir=map_dir)
+    plan_path = os.path.join(map_dir, '..', 'plan.json')
+    sync.do(maps=None, jobs=1, plan_path=plan_path)
+    planned = [nis_map_entry(ad=ad, dn=dn) for dn in [KEY0, KEY1]]
+    if hand_edit is True:
+        ad.do(op='modify', dn=KEY0,
+              args=[(ldap.MOD_REPLACE, 'nisMapEntry', ['-ro hacked:/x'])])
+    code = 0
+    try:
+        sync.apply_file(pathname=plan_path)
+    except SystemExit as e:
+        code = e.code
+    return (code, planned,
+            [nis_map_entry(ad=ad, dn=dn) for dn in [KEY0, KEY1]])
+
+
+def stale_plan(ad=None, map_dir=None):
+    return plan_and_apply(ad=ad, map_dir=map_dir, hand_edit=True)
+
+
+def killed_mode(mode=None, plan_path=None, **kwargs):
+    ''' Stands in for sync.do_mode(): mode b dies after saving its part. '''
+    plan.save_part(pathname=plan_path, mode=mode, container=CONTAINER,
+                   ops=[])
+    if mode == 'b':
+        os.kill(os.getpid(), signal.SIGKILL)
+    return
+
+
+def killed(ad=None, map_dir=None):
+    conf.c['modes'] = ['a', 'b']
+    sync.do_mode = killed_mode
+    plan_path = os.path.join(map_dir, '..', 'plan.json')
+    try:
+        sync.do(maps=None, jobs=1, plan_path=plan_path)
+    except SystemExit as e:
+        return e.code, sorted(os.listdir(os.path.dirname(plan_path)))
+    return None
+
+
+class SyncTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp(prefix='ampush-test.')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def run_scenario(self, scenario=None):
+        return run_scenario(scenario=scenario, tmp=self.tmp)
+
+    def test_first_push(self):
+        ff, ad = self.run_scenario(first_push)
+        self.assertEqual(ad, ff)
+
+    def test_manual_change_is_repaired(self):
+        good, after_dry_run, after_push = self.run_scenario(manual_change)
+        self.assertEqual(after_dry_run, '-ro hacked:/x')
+        self.assertEqual(after_push, good)
+
+    def test_apply(self):
+        code, planned, applied = self.run_scenario(plan_and_apply)
+        self.assertEqual(code, 0)
+        self.assertTrue('nfsnew' not in planned[0])
+        self.assertEqual(applied, ['-rw nfsnew:/key0', '-rw nfsnew:/key1'])
+
+    def test_apply_stale_plan(self):
+        code, planned, applied = self.run_scenario(stale_plan)
+        self.assertEqual(code, 21)
+        self.assertEqual(applied, ['-ro hacked:/x', planned[1]])
+
+    def test_killed_mode(self):
+        code, files = self.run_scenario(killed)
+        self.assertEqual(code, 24)
+        self.assertEqual(files, ['maps'])
+
+    def test_watch_passes(self):
+        first, second = self.run_scenario(watch_passes)
+        self.assertEqual(first, (15, True, 1, 0))
+        self.assertEqual(second, (0, True, 1, 0))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,114 @@
+'''
+watch.run(): collecting a burst of changes into one pass, and carrying on
+after a pass fails.
+Run with python -m unittest discover -s tests
+'''
+import logging
+import unittest
+import ldap
+from amlib import watch, sync, log
+from common import configure
+
+
+class Stop(Exception):
+    ''' Raised by Script once it has nothing left, to end watch.run(). '''
+    pass
+
+
+class Script(object):
+    ''' A watcher whose changes() returns what it's given, in turn. '''
+
+    def __init__(self, changes=None):
+        self.script = list(changes)
+        self.timeouts = []
+        self.closed = False
+
+    def changes(self, timeout=None):
+        if not self.script:
+            raise Stop()
+        self.timeouts.append(timeout)
+        return self.script.pop(0)
+
+    def close(self):
+        self.closed = True
+        return
+
+
+class DebounceTest(unittest.TestCase):
+
+    def setUp(self):
+        configure(watch_debounce='0.5')
+        self.passes = []
+        self.watchers = []
+        self._watcher, self._pass = watch.watcher, watch._pass
+        watch._pass = lambda map_names=None, dry_run=True, jobs=1: \
+            self.passes.append(map_names)
+
+    def tearDown(self):
+        watch.watcher, watch._pass = self._watcher, self._pass
+
+    def run_watch(self, *scripts):
+        scripts = list(scripts)
+
+        def watcher(pathname=None):
+            self.watchers.append(Script(scripts.pop(0)))
+            return self.watchers[-1]
+        watch.watcher = watcher
+        self.assertRaises(Stop, watch.run)
+        return
+
+    def test_burst_is_one_pass(self):
+        self.run_watch([set(), set(['auto.a']), set(['auto.b', 'auto.a']),
+                        set(), set(['auto.c']), set()])
+        self.assertEqual(self.passes, [None, set(['auto.a', 'auto.b']),
+                                       set(['auto.c'])])
+        self.assertEqual(self.watchers[0].timeouts,
+                         [None, None, 0.5, 0.5, None, 0.5])
+
+    def test_lost_track(self):
+        self.run_watch([set(['auto.a']), None, set()],
+                       [set(['auto.b']), set()])
+        self.assertEqual(self.passes, [None, None, set(['auto.b'])])
+        self.assertTrue(self.watchers[0].closed)
+
+
+class Collect(logging.Handler):
+    ''' Keep the records logged, instead of printing them. '''
+
+    def __init__(self):
+        logging.Handler.__init__(self)
+        self.records = []
+
+    def emit(self, record):
+        self.records.append(record)
+
+
+class RecoveryTest(unittest.TestCase):
+
+    def setUp(self):
+        configure()
+        self._watch_pass = sync.watch_pass
+        self._handlers = log.m.handlers
+        self.logged = Collect()
+        log.m.handlers = [self.logged]
+
+    def tearDown(self):
+        sync.watch_pass = self._watch_pass
+        log.m.handlers = self._handlers
+
+    def test_pass_failures_are_logged(self):
+        for e in [SystemExit(20), ldap.SERVER_DOWN({'desc': 'gone'}),
+                  ValueError('bad')]:
+            def fail(map_names=None, dry_run=True, jobs=1):
+                raise e
+            sync.watch_pass = fail
+            self.assertEqual(watch._pass(map_names=None), None)
+        self.assertEqual([r.levelno for r in self.logged.records],
+                         [logging.ERROR] * 3)
+        self.assertTrue('exit code 20' in self.logged.records[0].getMessage())
+        self.assertTrue('SERVER_DOWN' in self.logged.records[1].getMessage())
+        self.assertTrue(self.logged.records[2].exc_info is not None)
+
+
+if __name__ == '__main__':
+    unittest.main()